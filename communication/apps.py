@@ -1,75 +1,72 @@
-import os
 import logging
 from django.apps import AppConfig
-from django.core.signals import request_started
-from django.conf import settings  
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_migrate
+from django.conf import settings
 
 logger = logging.getLogger(__name__)
-setup_done = False
 
 class CommunictionConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'communication'
 
     def ready(self):
-        request_started.connect(setup_schedules_once)
+        # schedules and mailbox are provisioned by migrate (deploy), never in the request path
+        post_migrate.connect(setup_schedules, sender=self)
 
-# setup schedule once at startup
-def setup_schedules_once(sender, **kwargs):
-    global setup_done
-    if not setup_done:
-        setup_schedules()
-        setup_done = True
-
-# create schedule for email, twilio and reminders
-def setup_schedules():
-    from django_q.models import Schedule  
-    from django_q.tasks import schedule
+# create schedule for email, twilio and the mailbox entry, existing rows are updated in place
+def setup_schedules(using=DEFAULT_DB_ALIAS, **kwargs):
+    from django_q.models import Schedule
     from django_mailbox.models import Mailbox
+    from neighborow.polling import tables_exist, upsert_schedule
+
+    if not tables_exist(using, Schedule, Mailbox):
+        logger.info("Setup skipped: django_q or django_mailbox is not migrated.")
+        return
 
-    #Schedule.objects.all().delete()
-    logger.info("Starting Setup: Delete mail_sender_task Schedules.")
-    # delete existing mail sender schedule
-    Schedule.objects.filter(name='mail_sender_task').delete()
-    
-    # create schedule for mail sender
-    schedule(
-        'communication.tasks.mail_sender_task',  # Pfad zur Task-Funktion
-        name='mail_sender_task',
-        schedule_type=Schedule.MINUTES,     
+    # adaptive schedules (see neighborow.polling): the tasks set their own interval
+    upsert_schedule(
+        'mail_sender_task',
+        'communication.tasks.mail_sender_task',
+        keep=('minutes',),
+        schedule_type=Schedule.MINUTES,
         minutes=1,
         repeats=-1,
     )
-    logger.info("Mail Sender Schedule created!")
-
-    # delete existing fetch mail schedule
-    logger.info("Starting Setup: Delete fetch_mails Schedules.")
-    Schedule.objects.filter(name='fetch_mails').delete()
-
-    # create fetch mail schedule
-    schedule(
-        'communication.tasks.fetch_mails',  # Pfad zur Task-Funktion 
-        name='fetch_mails',      
-        schedule_type=Schedule.MINUTES,     
+    upsert_schedule(
+        'fetch_mails',
+        'communication.tasks.fetch_mails',
+        keep=('minutes',),
+        schedule_type=Schedule.MINUTES,
         minutes=1,
         repeats=-1,
     )
-    logger.info("Mail Receiver Schedule created!")
 
-    # delete all existing mailbox configuration entries
-    logger.info("Deleting all Mailbox entries.")
-    Mailbox.objects.all().delete()
+    # incoming sms arrive through the receive_sms webhook, the sweep only picks up missed ones
+    upsert_schedule(
+        'sms_reconciliation',
+        'communication.tasks.sms_reconciliation_task',
+        schedule_type=Schedule.MINUTES,
+        minutes=getattr(settings, "NEIGHBOROW_SMS_SWEEP_MINUTES", 60),
+        repeats=-1,
+    )
 
-    # create mailbox configuration entry
-    logger.info("Creating dynamic mailbox from settings.")
+    # mailbox configuration entry, updated in place so received mails are kept
     mailbox_uri = getattr(settings, "NEIGHBOROW_MAILBOX_URI", None)
     if mailbox_uri is None:
         logger.error("NEIGHBOROW_MAILBOX_URI is not defined in settings!")
     else:
-        Mailbox.objects.create(
-            name="Neighborow Mailbox",
-            uri=mailbox_uri,
-        )
-        logger.info("Dynamic mailbox created with URI: %s", mailbox_uri)
+        mailboxes = Mailbox.objects.filter(name="Neighborow Mailbox").order_by('id')
+        mailbox = mailboxes.first()
+        if mailbox is None:
+            Mailbox.objects.create(name="Neighborow Mailbox", uri=mailbox_uri)
+            logger.info("Dynamic mailbox created with URI: %s", mailbox_uri)
+        else:
+            if mailbox.uri != mailbox_uri:
+                mailbox.uri = mailbox_uri
+                mailbox.save(update_fields=['uri'])
+                logger.info("Mailbox URI updated: %s", mailbox_uri)
+            # duplicates left by the old startup setup only stop fetching, their mails are still processed
+            mailboxes.exclude(id=mailbox.id).update(active=False)
 
     logger.info("Setup completed.")
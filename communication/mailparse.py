@@ -0,0 +1,98 @@
+import email
+import logging
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import BeautifulSoup
+from django.conf import settings
+from email_reply_parser import EmailReplyParser
+
+# parsing stage of process_mails: raw mail bytes in, (title, reply text) out
+# the functions in this module do not touch the database, so they can run in worker processes
+
+logger = logging.getLogger(__name__)
+
+# number of parser processes, 1 parses in the calling process
+MAIL_PARSE_WORKERS = getattr(settings, "NEIGHBOROW_MAIL_PARSE_WORKERS", 4)
+# smaller batches are parsed serially, handing them to the pool costs more than it saves
+MAIL_PARSE_MIN_PARALLEL = getattr(settings, "NEIGHBOROW_MAIL_PARSE_MIN_PARALLEL", 50)
+
+# message code in the subject of a reply mail
+MAIL_CODE_PATTERN = re.compile(r"\(Code:\s*(\w{16})\)")
+
+
+# decode the text of one mime part, errors are logged and give an empty text
+def decode_part(part, error_text):
+    try:
+        charset = part.get_content_charset() or 'utf-8'
+        return part.get_payload(decode=True).decode(charset, errors='ignore')
+    except Exception as e:
+        logger.error(f"{error_text}: {e}")
+        return ""
+
+# plain text of a mail, html-only mails are converted to text
+def get_plaintext(email_object, raw):
+    plaintext_body = ""
+    html_body = ""
+
+    if email_object.is_multipart():
+        for part in email_object.walk():
+            content_type = part.get_content_type()
+            content_disposition = str(part.get("Content-Disposition"))
+            # extract message text
+            if content_type == "text/plain" and "attachment" not in content_disposition:
+                plaintext_body += decode_part(part, "Error decoding text/plain")
+            # extract html-content
+            elif content_type == "text/html" and "attachment" not in content_disposition:
+                html_body += decode_part(part, "Error decoding text/html")
+    else:
+        content_type = email_object.get_content_type()
+        if content_type == 'text/plain':
+            plaintext_body = decode_part(email_object, "Error decoding (not multipart, text/plain)")
+        elif content_type == 'text/html':
+            html_body = decode_part(email_object, "Error decoding (not multipart, text/html)")
+        else:
+            plaintext_body = raw.decode('utf-8', errors='ignore')  # Fallback
+
+    # If plain text is missing but HTML content is available,
+    # convert the HTML content to plain text.
+    if not plaintext_body and html_body:
+        soup = BeautifulSoup(html_body, 'html.parser')
+        plaintext_body = soup.get_text(separator=" ", strip=True)
+    return plaintext_body
+
+# title and reply text of one received mail
+# job: (raw mail bytes, subject, from header, reply matchers), the reply matchers are
+# (sender address part, ReplyMarkerMatcher) pairs of the providers configured for the building
+def parse_reply_mail(job):
+    raw, subject, from_header, reply_matchers = job
+    # strip title to 150 characters
+    title = MAIL_CODE_PATTERN.sub("", subject).strip()[:150]
+
+    email_object = email.message_from_bytes(raw)
+    # Remove the original message using python-email-reply-parser,
+    # so that only the reply text remains.
+    reply_text = EmailReplyParser.parse_reply(get_plaintext(email_object, raw))[:2100]
+
+    # Processing of reply based on app-settings (provider specific reply markers)
+    from_header = from_header.lower()
+    for provider, matcher in reply_matchers:
+        if provider in from_header and reply_text != '':
+            reply_text = matcher.strip(reply_text)
+    return title, reply_text
+
+# parse a batch of mails, in the pool when it is given and the batch is large enough
+def parse_reply_mails(jobs, pool=None):
+    if pool is None or len(jobs) < MAIL_PARSE_MIN_PARALLEL:
+        return [parse_reply_mail(job) for job in jobs]
+    chunksize = max(1, len(jobs) // (MAIL_PARSE_WORKERS * 4))
+    return list(pool.map(parse_reply_mail, jobs, chunksize=chunksize))
+
+# process pool for parse_reply_mails or None when parsing has to stay in this process
+# (single worker or cpu, or a daemonic django-q worker, which cannot start children)
+def get_parse_pool(workers=MAIL_PARSE_WORKERS):
+    workers = min(workers, os.cpu_count() or 1)
+    if workers <= 1 or multiprocessing.current_process().daemon:
+        return None
+    return ProcessPoolExecutor(max_workers=workers)
@@ -0,0 +1,67 @@
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from django.core.management.base import BaseCommand
+from communication.mailparse import MAIL_PARSE_WORKERS, get_parse_pool, parse_reply_mails
+from communication.replymarkers import ReplyMarkerMatcher
+
+# html reply with a quoted newsletter-style original message
+def build_html(i):
+    rows = "".join(
+        f"<tr><td style='padding:4px'><a href='https://example.com/item/{n}'>Item {n}</a></td>"
+        f"<td><img src='https://example.com/img/{n}.png' alt='item {n}'></td><td>{'lorem ipsum ' * 8}</td></tr>"
+        for n in range(60)
+    )
+    return (
+        f"<html><body><div>Reply number {i}: yes, I can lend it tomorrow.</div>"
+        f"<blockquote><p>On Monday Neighborow wrote:</p><table>{rows}</table></blockquote></body></html>"
+    )
+
+# synthetic corpus: every second mail multipart/alternative, the others html-only
+def build_corpus(count):
+    reply_matchers = (("gmx", ReplyMarkerMatcher(["Gesendet:", "Sent:"], "neighborow@gmx.net")),)
+    jobs = []
+    for i in range(count):
+        subject = f"Re: Borrowing request (Code: CODE{i:012d})"
+        if i % 2:
+            mail = MIMEMultipart('alternative')
+            mail.attach(MIMEText(f"Reply number {i}\n\nOn Monday Neighborow wrote:\n> quoted text", 'plain', 'utf-8'))
+            mail.attach(MIMEText(build_html(i), 'html', 'utf-8'))
+        else:
+            mail = MIMEText(build_html(i), 'html', 'utf-8')
+        mail['Subject'] = subject
+        mail['From'] = f"neighbour{i}@gmx.net"
+        jobs.append((mail.as_bytes(), subject, mail['From'], reply_matchers))
+    return jobs
+
+
+class Command(BaseCommand):
+    help = "Compare serial and process pool parsing of received reply mails on a synthetic corpus"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mails', type=int, default=2000)
+        parser.add_argument('--workers', type=int, default=MAIL_PARSE_WORKERS)
+
+    def handle(self, *args, **options):
+        jobs = build_corpus(options['mails'])
+        start = time.perf_counter()
+        serial = parse_reply_mails(jobs)
+        serial_seconds = time.perf_counter() - start
+
+        pool = get_parse_pool(options['workers'])
+        if pool is None:
+            self.stdout.write("Process pool not available, only serial parsing measured.")
+            pool_seconds = None
+        else:
+            with pool:
+                start = time.perf_counter()
+                parallel = parse_reply_mails(jobs, pool)
+                pool_seconds = time.perf_counter() - start
+            assert parallel == serial
+
+        self.stdout.write(f"serial: {len(jobs) / serial_seconds:.0f} mails/s ({serial_seconds:.2f}s)")
+        if pool_seconds:
+            self.stdout.write(
+                f"pool ({options['workers']} workers): {len(jobs) / pool_seconds:.0f} mails/s "
+                f"({pool_seconds:.2f}s, {serial_seconds / pool_seconds:.1f}x)"
+            )
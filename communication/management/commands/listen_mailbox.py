@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from communication.imaplistener import IMAP_URI, MailboxListener
+
+
+class Command(BaseCommand):
+    help = "Keep an IMAP connection open and process new reply mails as soon as they arrive (IDLE)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uri', default=IMAP_URI, help="imap mailbox uri, default NEIGHBOROW_IMAP_URI")
+        parser.add_argument('--once', action='store_true', help="fetch the new mails once and exit")
+
+    def handle(self, *args, **options):
+        listener = MailboxListener(options['uri'])
+        if options['once']:
+            self.stdout.write("Fetching new mails.")
+        else:
+            self.stdout.write(f"Listening for new mails on {listener.host}/{listener.folder}.")
+        listener.run(once=options['once'])
@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# refill the bucket for the time since the last call and take up to the requested tokens
+# KEYS[1] bucket key, ARGV: rate (tokens per second), capacity, requested tokens (negative to refund), now
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1])
+local timestamp = tonumber(bucket[2])
+if tokens == nil then
+    tokens = capacity
+    timestamp = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+local granted = math.min(requested, math.floor(tokens))
+tokens = math.min(capacity, tokens - granted)
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'timestamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return granted
+"""
+
+# token bucket shared by all django-q workers, state is kept in the Q_CLUSTER redis
+class RedisTokenBucket:
+    def __init__(self, name, rate, capacity, connection):
+        self.key = f"neighborow:ratelimit:{name}"
+        self.rate = rate
+        self.capacity = capacity
+        self.script = connection.register_script(TOKEN_BUCKET_SCRIPT)
+
+    # take up to tokens from the bucket, returns the number of granted tokens
+    def acquire(self, tokens=1):
+        return int(self.script(keys=[self.key], args=[self.rate, self.capacity, tokens, time.time()]))
+
+    # give back tokens that were granted but not used
+    def refund(self, tokens):
+        if tokens > 0:
+            self.script(keys=[self.key], args=[self.rate, self.capacity, -tokens, time.time()])
+
+
+# token bucket of one worker process, used without redis (tests, development)
+class LocalTokenBucket:
+    def __init__(self, name, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    # take up to tokens from the bucket, returns the number of granted tokens
+    def acquire(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            granted = min(tokens, int(self.tokens))
+            self.tokens -= granted
+            return granted
+
+    # give back tokens that were granted but not used
+    def refund(self, tokens):
+        if tokens > 0:
+            with self.lock:
+                self.tokens = min(self.capacity, self.tokens + tokens)
+
+
+buckets = {}
+buckets_lock = threading.Lock()
+
+# return the rate limiter of a channel ('email', 'sms') or None if the channel is not limited
+def get_rate_limiter(name):
+    limits = getattr(settings, "NEIGHBOROW_RATE_LIMITS", {}).get(name)
+    if not limits:
+        return None
+    with buckets_lock:
+        if name not in buckets:
+            backend = getattr(settings, "NEIGHBOROW_RATE_LIMIT_BACKEND", "redis")
+            if backend == "redis":
+                from django_q.brokers.redis_broker import Redis
+                buckets[name] = RedisTokenBucket(name, limits['rate'], limits['capacity'], Redis.get_connection())
+            else:
+                buckets[name] = LocalTokenBucket(name, limits['rate'], limits['capacity'])
+        return buckets[name]
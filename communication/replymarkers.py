@@ -0,0 +1,32 @@
+import re
+from neighborow.models import ApplicationSettings
+
+# mail providers that quote the original message behind a localized reply marker
+# AppSettings key with the comma separated markers -> part of the sender address of that provider
+# (new providers: add an ApplicationSettings key and an entry here)
+REPLY_MARKER_PROVIDERS = {
+    ApplicationSettings.REPLY_MAIL_GMX: "gmx",
+}
+
+
+# cuts the quoted original message from a reply: all markers in one case-insensitive regex,
+# the text is cut at the first marker that is followed by our own address (the quoted header)
+class ReplyMarkerMatcher:
+    def __init__(self, markers, address):
+        markers = sorted({marker.strip() for marker in markers if marker.strip()}, key=len, reverse=True)
+        self.pattern = re.compile("|".join(re.escape(marker) for marker in markers), re.IGNORECASE) if markers else None
+        self.address = address.lower()
+
+    # matcher from the comma separated value of an AppSettings row
+    @classmethod
+    def from_setting(cls, value, address):
+        return cls(value.split(","), address)
+
+    def strip(self, body):
+        if self.pattern is None:
+            return body
+        for match in self.pattern.finditer(body):
+            # search for our address behind the marker, ignoring blanks
+            if self.address in body[match.end():].replace(" ", "").lower():
+                return body[:match.start()]
+        return body
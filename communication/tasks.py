@@ -1,15 +1,34 @@
+from django.conf import settings
 from django.core.management import call_command
 from django.core.mail import send_mail
 from django_q.tasks import schedule
-from .utils import send_unsent_messages, process_mails, process_incoming_sms
+from neighborow.models import Messages
+from neighborow.polling import (DISPATCH_POLL_MAX_MINUTES, DISPATCH_SCHEDULE, FETCH_MAILS_SCHEDULE,
+                                MAIL_POLL_MAX_MINUTES, reschedule)
+from .utils import send_unsent_messages, process_mails, process_incoming_sms, delete_twilio_message, get_twilio_client
 
-# get and process incoming mails, sms
+# get and process incoming mails
+# (incoming sms arrive through the receive_sms webhook)
+# with the listen_mailbox command running, the mails are already fetched and processed there
+# idle runs back off (see neighborow.polling)
 def fetch_mails():
-    call_command('getmail')
-    process_mails()
+    processed = 0
+    if not getattr(settings, "NEIGHBOROW_MAIL_LISTENER", False):
+        call_command('getmail')
+        processed = process_mails()
+    reschedule(FETCH_MAILS_SCHEDULE, processed > 0, MAIL_POLL_MAX_MINUTES)
+
+# pick up incoming sms the receive_sms webhook missed
+def sms_reconciliation_task():
     process_incoming_sms()
 
+# delete an sms received by the webhook from the Twilio message log
+def delete_twilio_message_task(sid):
+    delete_twilio_message(get_twilio_client(), sid)
+
 # send outgoing mails, sms
+# a run that sent messages runs again on the next scheduler cycle, idle runs back off,
+# but not past the next delivery retry
 def mail_sender_task():
-    send_unsent_messages()
-
+    dispatched = send_unsent_messages()
+    reschedule(DISPATCH_SCHEDULE, dispatched > 0, DISPATCH_POLL_MAX_MINUTES, Messages.custom_objects.next_retry_at())
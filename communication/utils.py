@@ -1,373 +1,627 @@
 import logging
 import re
+import datetime
+import random
 import email
 import uuid
 from email import policy
 import base64
 import quopri
-from bs4 import BeautifulSoup
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from django.http import HttpResponse
-from django.db.models import Q
+from django.db import transaction
 from django.conf import settings
-from django.core.mail import send_mail
+from django.utils import timezone
+from django.core.mail import EmailMessage, get_connection
 from django.contrib.auth.models import User
-from email_reply_parser import EmailReplyParser
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
 from twilio.twiml.messaging_response import MessagingResponse
-from neighborow.models import Messages, MessageType, Borrowing_Request_Recipients, Communication, Channels, AppSettings, ApplicationSettings
+from neighborow.models import Messages, MessageType, Borrowing_Request_Recipients, Communication, Channels, AppSettings, Delivery_Attempt, Inbound_Message, Inbound_Watermark
 from django_mailbox.models import Message as MailboxMessage
 from neighborow.utils import generate_unique_message_code
+from .ratelimit import get_rate_limiter
+from .mailparse import MAIL_CODE_PATTERN, parse_reply_mails
+from .replymarkers import REPLY_MARKER_PROVIDERS, ReplyMarkerMatcher
 
 logger = logging.getLogger(__name__)
 
-# send unsent messages
-def send_unsent_messages():
-    # get al´l unsent messages
-    unsent_messages = Messages.objects.filter(
-        Q(is_sent_email=False) | Q(is_sent_sms=False) | Q(is_sent_whatsApp=False),
-        outbox=True,
-        inbox=False
-    )
-    # loop through unsent messages using all communication channels
-    for message in unsent_messages:
-        recipient = message.receiver_member_id
-
-        if message.is_sent_email == False:
-            # 1. send emails
-            email_comms = Communication.objects.filter(
-                member_id=recipient,
-                channel=Channels.EMAIL,
-                is_active=True
-            )
-            if email_comms.exists():
-                email_addresses = [comm.identification for comm in email_comms]
-                subject = f"{message.title} (Code: {message.message_code})"
-                try:
-                    send_mail(
-                        subject=subject,
-                        message=message.body,
-                        from_email=settings.DEFAULT_FROM_EMAIL,
-                        recipient_list=email_addresses,
-                        fail_silently=False,
-                        html_message=None,
-                    )
-                    message.is_sent_email = True
-                    message.save(update_fields=['is_sent_email'])
-                except Exception as e:
-                    logger.error(f"Error sending email messages {message.id} an {email_addresses}: {e}")
-            else:
-                message.is_sent_email = True
-                message.save(update_fields=['is_sent_email'])
-
-        if message.is_sent_sms == False:
-            # 2. send sms via Twilio
-            sms_comms = Communication.objects.filter(
-                member_id=recipient,
-                channel=Channels.SMS,
-                is_active=True
-            )
-            if sms_comms.exists():
-                client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-                sms_sent = False
-                for comm in sms_comms:
-                    sms_body = f"{message.title} (Code: {message.message_code}) {message.body}"
-                    trimmed_body = sms_body[:420] # send only first 420 charachters - 3 sms messages
-                    try:
-                        sms_response = client.messages.create(
-                            body=trimmed_body,
-                            from_=settings.TWILIO_PHONE_NUMBER,
-                            to=comm.identification  # Twilio Trial-Modus: only registered snder phone numbers
-                        )
-                        logger.info(f"SMS sent to {comm.identification}. SID: {sms_response.sid}")
-                        sms_sent = True
-                    except Exception as e:
-                        logger.error(f"Error sending sms messages {message.id} an {comm.identification}: {e}")
-                if sms_sent:
-                    message.is_sent_sms = True
-                    message.save(update_fields=['is_sent_sms'])
-            else:
-                message.is_sent_sms = True
-                message.save(update_fields=['is_sent_sms'])
-
-        if message.is_sent_whatsApp == False:
-            # 3. send WhatsApp via Twilio
-            # whatsapp_comms = Communication.objects.filter(
-            #     member_id=recipient,
-            #     channel=Channels.WHATSAPP,
-            #     is_active=True
-            # )
-            # if whatsapp_comms.exists():
-            #     client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-            #     whatsapp_sent = False
-            #     for comm in whatsapp_comms:
-            #         whatsapp_body = f"{message.title} {message.body}"
-            #         try:
-            #
-            #             whatsapp_response = client.messages.create(
-            #                 body=whatsapp_body,
-            #                 from_="whatsapp:" + settings.TWILIO_WHATSAPP_NUMBER,
-            #                 to="whatsapp:" + comm.identification
-            #             )
-            #             logger.info(f"WhatsApp sent to {comm.identification}. SID: {whatsapp_response.sid}")
-            #             whatsapp_sent = True
-            #         except Exception as e:
-            #             logger.error(f"Error sending WhatsApp messagest {message.id} an {comm.identification}: {e}")
-            #     if whatsapp_sent:
-            #         message.is_sent_whatsApp = True
-            #         message.save(update_fields=['is_sent_whatsApp'])
-            # else:
-            message.is_sent_whatsApp = True
-            message.save(update_fields=['is_sent_whatsApp'])            
-
-
-        # update corresponding Borrowing_Request_Recipients if typs is BORREQ
-        if message.message_type == MessageType.BORREQ.value:
-            Borrowing_Request_Recipients.objects.filter(
-                member_id=recipient,
-                pk=message.message_type_id,
-                message_id__isnull=True
-            ).update(message_id=message)
-
-# process incoming messages
-def gmx_processing(body):
+# number of outbox rows the dispatcher handles per batch
+DISPATCH_BATCH_SIZE = getattr(settings, "NEIGHBOROW_DISPATCH_BATCH_SIZE", 200)
+# lease time of claimed outbox rows, expired leases are picked up by the next run
+DISPATCH_LEASE_SECONDS = getattr(settings, "NEIGHBOROW_DISPATCH_LEASE_SECONDS", 120)
+# number of concurrent Twilio requests per worker and their timeout in seconds
+SMS_MAX_WORKERS = getattr(settings, "NEIGHBOROW_SMS_MAX_WORKERS", 8)
+SMS_TIMEOUT = getattr(settings, "NEIGHBOROW_SMS_TIMEOUT", 10)
+# number of received mails processed (and held in memory) per batch
+MAIL_BATCH_SIZE = getattr(settings, "NEIGHBOROW_MAIL_BATCH_SIZE", 200)
+# reconciliation sweep: page size and maximum number of listed messages per run, overlap of
+# the date_sent watermark for messages Twilio stores late
+SMS_LIST_PAGE_SIZE = getattr(settings, "NEIGHBOROW_SMS_LIST_PAGE_SIZE", 100)
+SMS_LIST_LIMIT = getattr(settings, "NEIGHBOROW_SMS_LIST_LIMIT", 1000)
+SMS_WATERMARK_OVERLAP_SECONDS = getattr(settings, "NEIGHBOROW_SMS_WATERMARK_OVERLAP_SECONDS", 300)
+# failed deliveries are retried with exponential backoff and move to dead letter after the last attempt
+DELIVERY_MAX_ATTEMPTS = getattr(settings, "NEIGHBOROW_DELIVERY_MAX_ATTEMPTS", 8)
+DELIVERY_RETRY_BASE_SECONDS = getattr(settings, "NEIGHBOROW_DELIVERY_RETRY_BASE_SECONDS", 60)
+DELIVERY_RETRY_MAX_SECONDS = getattr(settings, "NEIGHBOROW_DELIVERY_RETRY_MAX_SECONDS", 6 * 60 * 60)
+
+twilio_client = None
+twilio_client_lock = threading.Lock()
+
+# shared Twilio client per worker process, all requests reuse one pooled http session
+def get_twilio_client():
+    global twilio_client
+    with twilio_client_lock:
+        if twilio_client is None:
+            http_client = TwilioHttpClient(timeout=SMS_TIMEOUT)
+            # pool as many connections as requests can run in parallel
+            http_client.session.mount("https://", HTTPAdapter(pool_maxsize=SMS_MAX_WORKERS))
+            twilio_client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN, http_client=http_client)
+            api_url = getattr(settings, "NEIGHBOROW_TWILIO_API_URL", None)
+            if api_url:
+                # local stand-in for the Twilio REST API (tests, development)
+                twilio_client.api.base_url = api_url
+    return twilio_client
+
+# load active email/sms communication entries for all recipients of a batch in one query
+def load_recipient_communications(recipient_ids):
+    comms = {}
+    for comm in Communication.objects.filter(
+        member_id__in=recipient_ids,
+        channel__in=[Channels.EMAIL, Channels.SMS],
+        is_active=True
+    ).only('member_id', 'channel', 'identification'):
+        comms.setdefault((comm.member_id_id, comm.channel), []).append(comm.identification)
+    return comms
+
+# send all emails of a batch over one smtp connection, returns ids of sent messages and errors
+def send_email_batch(email_jobs):
+    sent_ids = []
+    errors = {}
+    if not email_jobs:
+        return sent_ids, errors
+    connection = get_connection(fail_silently=False)
     try:
-        app_setting = AppSettings.objects.filter(key=ApplicationSettings.REPLY_MAIL_GMX).first()
-        if app_setting:
-            # reply patterns from app_settings
-            reply_values = [v.strip() for v in app_setting.value.split(",")]
-            new_body_lower = body.lower()
-            for reply in reply_values:
-                reply_lower = reply.lower()
-                index = new_body_lower.find(reply_lower)
-                if index != -1:
-                    # Strip return message
-                    substring = body[index + len(reply):]
-                    new_body = body[:index]
-
-                    # search for substring in EMAIL_HOST_USER case-insensitive
-                    if (settings.EMAIL_HOST_USER.lower() in substring.replace(" ", "").lower()):
-                        # delete from reply_value
-                        new_body = body[:index]
-                        # skip agter first hit
-                        break
-                    else:
-                        new_body = new_body
+        connection.open()
+        for message, email_addresses in email_jobs:
+            subject = f"{message.subject} (Code: {message.message_code})"
+            email_message = EmailMessage(
+                subject=subject,
+                body=message.text,
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                to=email_addresses,
+                connection=connection,
+            )
+            try:
+                # one message per call keeps the per message accounting, the connection stays open
+                if connection.send_messages([email_message]):
+                    sent_ids.append(message.id)
                 else:
-                    new_body = body                       
+                    errors[message.id] = "Email was not accepted by the mail server"
+            except Exception as e:
+                logger.error(f"Error sending email messages {message.id} an {email_addresses}: {e}")
+                errors[message.id] = str(e)
     except Exception as e:
-        logger.error(f"Error in additional filtering: {e}")
+        logger.error(f"Error opening email connection: {e}")
+        for message, email_addresses in email_jobs:
+            if message.id not in sent_ids:
+                errors.setdefault(message.id, str(e))
+    finally:
+        connection.close()
+    return sent_ids, errors
+
+# send one sms via the shared Twilio client, returns None on success or the error
+def send_sms(client, message_id, phone_number, body):
+    try:
+        sms_response = client.messages.create(
+            body=body,
+            from_=settings.TWILIO_PHONE_NUMBER,
+            to=phone_number  # Twilio Trial-Modus: only registered snder phone numbers
+        )
+        logger.info(f"SMS sent to {phone_number}. SID: {sms_response.sid}")
+        return None
+    except Exception as e:
+        logger.error(f"Error sending sms messages {message_id} an {phone_number}: {e}")
+        return str(e)
+
+# send all sms of a batch concurrently via Twilio, returns ids of messages with at least one sent sms and errors
+def send_sms_batch(sms_jobs):
+    sent_ids = []
+    errors = {}
+    if not sms_jobs:
+        return sent_ids, errors
+    client = get_twilio_client()
+    futures = {}
+    # bounded pool: at most SMS_MAX_WORKERS Twilio requests are in flight at the same time
+    with ThreadPoolExecutor(max_workers=SMS_MAX_WORKERS) as executor:
+        for message, phone_numbers in sms_jobs:
+            sms_body = f"{message.subject} (Code: {message.message_code}) {message.text}"
+            trimmed_body = sms_body[:420] # send only first 420 charachters - 3 sms messages
+            futures[message.id] = [
+                executor.submit(send_sms, client, message.id, phone_number, trimmed_body)
+                for phone_number in phone_numbers
+            ]
+    # a message counts as sent if at least one of its phone numbers was reached
+    for message_id, message_futures in futures.items():
+        results = [future.result() for future in message_futures]
+        if any(result is None for result in results):
+            sent_ids.append(message_id)
+        else:
+            errors[message_id] = results[-1]
+    return sent_ids, errors
+
+# exponential backoff with jitter for the next delivery attempt
+def next_delivery_attempt(attempts, now):
+    delay = min(DELIVERY_RETRY_BASE_SECONDS * 2 ** (attempts - 1), DELIVERY_RETRY_MAX_SECONDS)
+    # jitter spreads retries of messages that failed together
+    return now + datetime.timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+# record failed deliveries per message and channel, schedule retries or move to dead letter
+def record_delivery_failures(messages, attempts, errors, unsent_channels, deferred=()):
+    now = timezone.now()
+    new_attempts = []
+    changed_attempts = []
+    for channel, channel_errors in errors.items():
+        for message_id, error in channel_errors.items():
+            attempt = attempts.get((message_id, channel))
+            if attempt is None:
+                attempt = Delivery_Attempt(message_id_id=message_id, channel=channel)
+                attempts[(message_id, channel)] = attempt
+                new_attempts.append(attempt)
+            else:
+                changed_attempts.append(attempt)
+            attempt.attempts += 1
+            attempt.last_error = error[:500]
+            attempt.next_attempt_at = next_delivery_attempt(attempt.attempts, now)
+            if attempt.attempts >= DELIVERY_MAX_ATTEMPTS:
+                attempt.is_dead_letter = True
+                logger.warning(f"Delivery of message {message_id} via channel {channel} moved to dead letter: {error}")
+    if new_attempts:
+        Delivery_Attempt.objects.bulk_create(new_attempts)
+    if changed_attempts:
+        Delivery_Attempt.objects.bulk_update(changed_attempts, ['attempts', 'last_error', 'next_attempt_at', 'is_dead_letter'])
+
+    # message waits for the earliest retry of its channels, or is dead when only dead channels are left
+    changed_messages = []
+    for message in messages:
+        channels = unsent_channels.get(message.id)
+        if not channels:
+            continue
+        retries = []
+        for channel in channels:
+            attempt = attempts.get((message.id, channel))
+            if (message.id, channel) in deferred:
+                # deferred by the rate limiter, due again right away
+                retries.append(now)
+            elif not attempt.is_dead_letter:
+                retries.append(attempt.next_attempt_at or now)
+        if retries:
+            message.next_attempt_at = min(retries)
+        else:
+            message.is_dead_letter = True
+        changed_messages.append(message)
+    if changed_messages:
+        Messages.objects.bulk_update(changed_messages, ['next_attempt_at', 'is_dead_letter'])
+
+# take as many jobs as the channel rate limiter allows, one token per email or sms
+def limit_jobs(limiter_name, jobs):
+    limiter = get_rate_limiter(limiter_name)
+    if limiter is None or not jobs:
+        return jobs, []
+    needed = sum(len(addresses) for message, addresses in jobs)
+    granted = limiter.acquire(needed)
+    allowed = []
+    used = 0
+    for message, addresses in jobs:
+        if used + len(addresses) > granted:
+            break
+        allowed.append((message, addresses))
+        used += len(addresses)
+    limiter.refund(granted - used)
+    if len(allowed) < len(jobs):
+        logger.info(f"Rate limit for {limiter_name} reached, {len(jobs) - len(allowed)} messages deferred.")
+    return allowed, jobs[len(allowed):]
+
+# link borrowing request recipients to their outbox message
+def link_borrowing_request_recipients(messages):
+    borreq_messages = {
+        message.message_type_id: message
+        for message in messages
+        if message.message_type == MessageType.BORREQ.value and message.message_type_id is not None
+    }
+    if not borreq_messages:
+        return
+    recipients = list(Borrowing_Request_Recipients.objects.filter(
+        pk__in=borreq_messages.keys(),
+        message_id__isnull=True
+    ))
+    for recipient in recipients:
+        message = borreq_messages[recipient.pk]
+        if recipient.member_id_id == message.receiver_member_id_id:
+            recipient.message_id = message
+    recipients = [recipient for recipient in recipients if recipient.message_id_id is not None]
+    if recipients:
+        Borrowing_Request_Recipients.objects.bulk_update(recipients, ['message_id'])
+
+# dispatch one batch of unsent messages using all communication channels
+# returns True if a channel rate limit deferred part of the batch
+def dispatch_message_batch(messages):
+    now = timezone.now()
+    comms = load_recipient_communications({message.receiver_member_id_id for message in messages})
+    # earlier failed deliveries of this batch, dead channels are not tried again
+    attempts = {
+        (attempt.message_id_id, attempt.channel): attempt
+        for attempt in Delivery_Attempt.objects.filter(message_id__in=[message.id for message in messages])
+    }
+
+    email_done_ids = []
+    sms_done_ids = []
+    email_jobs = []
+    sms_jobs = []
+    unsent_channels = {}
+    for message in messages:
+        recipient = message.receiver_member_id_id
+
+        for channel, is_sent, done_ids, jobs in (
+            (Channels.EMAIL, message.is_sent_email, email_done_ids, email_jobs),
+            (Channels.SMS, message.is_sent_sms, sms_done_ids, sms_jobs),
+        ):
+            if is_sent:
+                continue
+            attempt = attempts.get((message.id, channel))
+            # dead channels are skipped, failed channels wait until their retry is due
+            if attempt is not None and (attempt.is_dead_letter or (attempt.next_attempt_at or now) > now):
+                unsent_channels.setdefault(message.id, []).append(channel)
+                continue
+            # 1. emails, 2. sms via Twilio - nothing to send without an active address
+            addresses = comms.get((recipient, channel))
+            if addresses:
+                jobs.append((message, addresses))
+            else:
+                done_ids.append(message.id)
+
+    # respect the provider rate limits, deferred messages stay unsent for the next run
+    email_jobs, deferred_email_jobs = limit_jobs('email', email_jobs)
+    sms_jobs, deferred_sms_jobs = limit_jobs('sms', sms_jobs)
+    deferred = set()
+    for channel, deferred_jobs in ((Channels.EMAIL, deferred_email_jobs), (Channels.SMS, deferred_sms_jobs)):
+        for message, addresses in deferred_jobs:
+            unsent_channels.setdefault(message.id, []).append(channel)
+            deferred.add((message.id, channel))
+
+    email_sent_ids, email_errors = send_email_batch(email_jobs)
+    sms_sent_ids, sms_errors = send_sms_batch(sms_jobs)
+    email_done_ids += email_sent_ids
+    sms_done_ids += sms_sent_ids
+
+    # write back sent flags with one update per channel
+    if email_done_ids:
+        Messages.objects.filter(id__in=email_done_ids).update(is_sent_email=True)
+    if sms_done_ids:
+        Messages.objects.filter(id__in=sms_done_ids).update(is_sent_sms=True)
+    # 3. WhatsApp is not sent yet, mark as done
+    whatsapp_ids = [message.id for message in messages if message.is_sent_whatsApp == False]
+    if whatsapp_ids:
+        Messages.objects.filter(id__in=whatsapp_ids).update(is_sent_whatsApp=True)
+
+    # schedule retries for failed channels
+    for channel, channel_errors in ((Channels.EMAIL, email_errors), (Channels.SMS, sms_errors)):
+        for message_id in channel_errors:
+            unsent_channels.setdefault(message_id, []).append(channel)
+    record_delivery_failures(
+        messages, attempts, {Channels.EMAIL: email_errors, Channels.SMS: sms_errors}, unsent_channels, deferred
+    )
+
+    # update corresponding Borrowing_Request_Recipients if typs is BORREQ
+    link_borrowing_request_recipients(messages)
+
+    return bool(deferred_email_jobs or deferred_sms_jobs)
+
+# send unsent messages, returns the number of messages handed to the providers
+def send_unsent_messages(batch_size=DISPATCH_BATCH_SIZE):
+    # lease pending messages batch by batch, overlapping runs never get the same rows
+    last_id = 0
+    dispatched = 0
+    while True:
+        claim_token, messages = Messages.custom_objects.claim_pending_delivery(
+            batch_size, DISPATCH_LEASE_SECONDS, after_id=last_id
+        )
+        if not messages:
+            break
+        dispatched += len(messages)
+        try:
+            throttled = dispatch_message_batch(messages)
+        finally:
+            # failed rows go back to the pool for the next run
+            Messages.custom_objects.release_claim(claim_token)
+        if throttled:
+            # a provider limit is reached, stop instead of spending the task time on rejected calls
+            break
+        last_id = messages[-1].id
+    return dispatched
+
+# compiled reply marker matchers per (building, AppSettings key), with the modified time of their row
+reply_matchers = {}
+
+# reply matchers of all buildings: {building id: ((sender address part, matcher), ...)}
+# one query per call, a matcher is only compiled again when its AppSettings row has changed
+def load_reply_matchers():
+    rows = AppSettings.objects.filter(
+        key__in=REPLY_MARKER_PROVIDERS.keys()
+    ).values_list('id', 'building_id', 'key', 'value', 'modified')
+    matchers = {}
+    for row_id, building_id, key, value, modified in rows:
+        cached = reply_matchers.get(row_id)
+        if cached is None or cached[0] != modified:
+            cached = (modified, ReplyMarkerMatcher.from_setting(value, settings.EMAIL_HOST_USER))
+            reply_matchers[row_id] = cached
+        matchers.setdefault(building_id, []).append((REPLY_MARKER_PROVIDERS[key], cached[1]))
+    # drop matchers of deleted rows
+    for row_id in set(reply_matchers) - {row[0] for row in rows}:
+        del reply_matchers[row_id]
+    return {building_id: tuple(building_matchers) for building_id, building_matchers in matchers.items()}
+
+# record received messages in the ingestion ledger, returns the external ids this run owns
+# must run in the transaction that stores the replies: ids already in the ledger
+# (ingested before or by a concurrent run) are left out and their replies are not written
+def claim_inbound_messages(channel, external_ids):
+    token = uuid.uuid4()
+    Inbound_Message.objects.bulk_create(
+        [Inbound_Message(channel=channel, external_id=external_id, claim_token=token) for external_id in external_ids],
+        ignore_conflicts=True
+    )
+    return set(Inbound_Message.objects.filter(claim_token=token).values_list('external_id', flat=True))
+
+# ledger key of a received mail: the Message-ID header, the mailbox row if the header is missing
+def get_mail_external_id(mail):
+    return (mail.message_id or f"mailbox:{mail.id}")[:255]
+
+# raw bytes of a received mail
+def get_mail_bytes(mail):
+    if mail.eml:
+        with mail.eml.open():
+            return mail.eml.file.read()
+    return mail.get_body()
+
+# sender and receiver of the latest delivered outbox message of each code, one query per batch
+def load_original_messages(codes):
+    original_messages = {}
+    rows = Messages.objects.filter(
+        message_code__in=codes,
+        is_sent_email=True,
+        outbox=True,
+        inbox=False
+    ).order_by('-created', '-id').values_list(
+        'message_code', 'sender_member_id', 'receiver_member_id', 'sender_member_id__building_id'
+    )
+    for code, sender_id, receiver_id, building_id in rows:
+        original_messages.setdefault(code, (sender_id, receiver_id, building_id))
+    return original_messages
+
+# turn one batch of mails into reply messages, then delete the whole batch
+def process_mail_batch(mails, admin_user, matchers=None, pool=None):
+    codes = {}
+    for mail in mails:
+        match = MAIL_CODE_PATTERN.search(mail.subject)
+        if match:
+            codes[mail.id] = match.group(1)
+    original_messages = load_original_messages(set(codes.values()))
+
+    # mails without message code or without original message are only deleted
+    reply_mails = [mail for mail in mails if codes.get(mail.id) in original_messages]
+    # reply markers of the building of the original sender
+    matchers = matchers or {}
+    parsed = parse_reply_mails([
+        (get_mail_bytes(mail), mail.subject, mail.from_header, matchers.get(original_messages[codes[mail.id]][2], ()))
+        for mail in reply_mails
+    ], pool)
+
+    new_messages = {}
+    for mail, (new_title, new_body) in zip(reply_mails, parsed):
+        code = codes[mail.id]
+        sender_id, receiver_id, building_id = original_messages[code]
+        # create record in message table with interchnaged sender/receiver
+        # a mail fetched twice (same Message-ID) gives one reply
+        new_messages.setdefault(get_mail_external_id(mail), Messages(
+            sender_member_id_id=receiver_id,  # interchnaged
+            receiver_member_id_id=sender_id,  # interchnaged
+            title=new_title,
+            body=new_body,
+            message_code=code,
+            inbox=True,
+            is_sent_email=True,
+            created_by=admin_user,
+        ))
 
-    return new_body
+    # ledger, replies and deletion commit together, a crash leaves the batch for the next run
+    # and mails already ingested by an earlier or overlapping run are only deleted
+    with transaction.atomic():
+        claimed = claim_inbound_messages(Channels.EMAIL, new_messages.keys())
+        new_messages = [message for external_id, message in new_messages.items() if external_id in claimed]
+        Messages.objects.bulk_create(new_messages)
+        MailboxMessage.objects.filter(id__in=[mail.id for mail in mails]).delete()
+    return len(new_messages)
 
-# process incoming mails
-def process_mails():
+# process incoming mails in batches, only one batch of mail bodies is held in memory
+# pool: process pool of the caller (see mailparse.get_parse_pool) for large batches, kept by a long-running
+# process such as the IMAP listener; without it the mails are parsed in this process
+# returns the number of processed mails
+def process_mails(batch_size=MAIL_BATCH_SIZE, pool=None):
     # get admin user
     try:
         admin_user = User.objects.get(username="admin")
     except User.DoesNotExist:
         raise Exception("Admin user not found.")
 
+    # reply markers are read once per run instead of once per mail
+    matchers = {}
+    try:
+        matchers = load_reply_matchers()
+    except Exception as e:
+        logger.error(f"Error in additional filtering: {e}")
+
     # only filter outgoing=False emails
-    mails = MailboxMessage.objects.filter(outgoing=False)
+    mails = MailboxMessage.objects.filter(outgoing=False).order_by('id')
 
-    valid_mails = []
-    # loop through all messages and search for message code
-    for mail in mails:
-        match = re.search(r"\(Code:\s*(\w{16})\)", mail.subject)
-        if match:
-            code = match.group(1)
-            valid_mails.append((mail, code))
-        else:
-            # delete emails without messgage code
-            mail.delete()
+    processed = 0
+    last_id = 0
+    while True:
+        batch = list(mails.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            break
+        process_mail_batch(batch, admin_user, matchers, pool)
+        processed += len(batch)
+        last_id = batch[-1].id
+    return processed
 
-    for mail, code in valid_mails:
-        # Search for original message to identify sender
-        original_messages = Messages.objects.filter(
+# store one received SMS as inbox message, used by the receive_sms webhook and the reconciliation sweep
+# returns False if the SMS cannot be assigned to a member (it stays at Twilio)
+def ingest_sms(sid, from_number, body, admin_user):
+    # Try to extract a 16-digit code from the SMS body using regex
+    code_match = re.search(r"Code:\s*(\w{16})", body)
+    if code_match:
+        code = code_match.group(1)
+        # Search for the original message in the Messages table (outbox message)
+        original_message = Messages.objects.filter(
             message_code=code,
-            is_sent_email=True,
             outbox=True,
             inbox=False
-        ).order_by('-created')
-        if not original_messages.exists():
-            mail.delete()
-            continue
-        original_message = original_messages.first()
-
-        # strip title to 150 characters
-        new_title = re.sub(r"\(Code:\s*(\w{16})\)", "", mail.subject).strip()[:150]
-
-        plaintext_body = ""
-        html_body = ""
-
-        # --- PROCESS EMAIL BODY ---
-        # get email.message.Message-Object 
-        email_object = mail.get_email_object()
-
-        if email_object.is_multipart():
-            for part in email_object.walk():
-                content_type = part.get_content_type()
-                content_disposition = str(part.get("Content-Disposition"))
-                # extract message text
-                if content_type == "text/plain" and "attachment" not in content_disposition:
-                    try:
-                        charset = part.get_content_charset() or 'utf-8'
-                        plaintext_body += part.get_payload(decode=True).decode(charset, errors='ignore')
-                    except Exception as e:
-                        logger.error(f"Error decoding text/plain: {e}")
-                # extract html-content
-                elif content_type == "text/html" and "attachment" not in content_disposition:
-                    try:
-                        charset = part.get_content_charset() or 'utf-8'
-                        html_body += part.get_payload(decode=True).decode(charset, errors='ignore')
-                    except Exception as e:
-                        logger.error(f"Error decoding text/html: {e}")
-        else:
-            content_type = email_object.get_content_type()
-            if content_type == 'text/plain':
-                try:
-                    charset = email_object.get_content_charset() or 'utf-8'
-                    plaintext_body = email_object.get_payload(decode=True).decode(charset, 'ignore')
-                except Exception as e:
-                    logger.error(f"Error decoding (not multipart, text/plain): {e}")
-            elif content_type == 'text/html':
-                try:
-                    charset = email_object.get_content_charset() or 'utf-8'
-                    html_body = email_object.get_payload(decode=True).decode(charset, 'ignore')
-                except Exception as e:
-                    logger.error(f"Error decoding (not multipart, text/html): {e}")
-            else:
-                plaintext_body = mail.body  # Fallback
-
-        # If plain text is missing but HTML content is available,
-        # convert the HTML content to plain text.
-        if not plaintext_body and html_body:
-            soup = BeautifulSoup(html_body, 'html.parser')
-            plaintext_body = soup.get_text(separator=" ", strip=True)
+        ).select_related('content_id').order_by("-created").first()
 
-        # Remove the original message using python-email-reply-parser,
-        # so that only the reply text remains.
-        reply_text = EmailReplyParser.parse_reply(plaintext_body)
-        new_body = reply_text[:2100]
+        if not original_message:
+            logger.error(f"No original message found with code {code}. SMS SID {sid} skipped.")
+            return False
 
-        # --- NEW BLOCK: Processing of reply based on app-settings ---
-        if "gmx" in mail.from_header.lower() and new_body != '':
-            new_body = gmx_processing(new_body)
-        # --- END NEW BLOCK ---
-
-        # create record in message table with interchnaged sender/receiver
+        # reply with the SMS text to the sender of the original message
         new_message = Messages(
-            sender_member_id=original_message.receiver_member_id,  # interchnaged
-            receiver_member_id=original_message.sender_member_id,  # interchnaged
-            title=new_title,
-            body=new_body,
+            sender_member_id_id=original_message.receiver_member_id_id,  # Reply is sent from the original recipient
+            receiver_member_id_id=original_message.sender_member_id_id,  # Reply is sent to the original sender
+            title=("Re: " + original_message.subject)[:175],
+            body=body[:2100],
             message_code=code,
             inbox=True,
+            outbox=False,
+            internal=False,
             is_sent_email=True,
+            is_sent_sms=True,
+            is_sent_whatsApp=True,
+            message_type=MessageType.INCOMING_SMS.value,
             created_by=admin_user,
         )
+        log_text = f"New reply message created for code {code}."
+    else:
+        # No code found – fallback via SMS identification
+        sms_identification = Communication.objects.filter(
+            channel=Channels.SMS,
+            identification=from_number,
+            is_active=True
+        ).first()
+        if not sms_identification:
+            logger.error(f"No SMS Communication entry found for number {from_number}. SMS SID {sid} skipped.")
+            return False
+
+        # Generate a unique fallback code
+        fallback_code = generate_unique_message_code()
+        appended_text = "\nThis message could not be assigned to any sender because the code was missing."
+        new_sms_body = body[:2100 - len(appended_text)] + appended_text
+        new_message = Messages(
+            sender_member_id_id=sms_identification.member_id_id,  # Use the member from the SMS communication
+            receiver_member_id_id=sms_identification.member_id_id,  # Association via SMS communication
+            title=("Fallback SMS: " + body)[:175],
+            body=new_sms_body,
+            message_code=fallback_code,
+            inbox=True,
+            outbox=False,
+            internal=False,
+            is_sent_email=True,
+            is_sent_sms=True,
+            is_sent_whatsApp=True,
+            message_type=MessageType.INCOMING_SMS.value,
+            created_by=admin_user,
+        )
+        log_text = f"New fallback message created for number {from_number} (no code found)."
+
+    # the ledger entry commits with the message, an SMS delivered by the webhook and
+    # listed again by the sweep (or whose deletion failed) is not stored twice
+    with transaction.atomic():
+        if not claim_inbound_messages(Channels.SMS, [sid]):
+            logger.info(f"SMS SID {sid} has already been processed.")
+            return True
         new_message.save()
-        # delete processed message from mail table
-        mail.delete()
+    logger.info(f"{log_text} (ID: {new_message.id})")
+    return True
+
+# Delete a processed SMS from the Twilio message log
+def delete_twilio_message(client, sid):
+    deletion_success = client.messages(sid).delete()
+    if deletion_success:
+        logger.info(f"SMS SID {sid} successfully deleted from Twilio.")
+    else:
+        logger.warning(f"SMS SID {sid} could not be deleted from Twilio.")
+    return deletion_success
 
-# Retrieves all incoming SMS messages from Twilio that were sent to the central TWILIO_PHONE_NUMBER
+# Delete processed SMS from the Twilio message log in parallel through the shared client
+def delete_twilio_messages(client, sids):
+    def delete(sid):
+        try:
+            return delete_twilio_message(client, sid)
+        except Exception as e:
+            logger.error(f"Error deleting SMS SID {sid}: {e}")
+            return False
+
+    if not sids:
+        return 0
+    with ThreadPoolExecutor(max_workers=min(SMS_MAX_WORKERS, len(sids))) as executor:
+        return sum(1 for deleted in executor.map(delete, sids) if deleted)
+
+# Reconciliation sweep: retrieves the SMS messages stored at Twilio for the central TWILIO_PHONE_NUMBER
+# that were sent after the watermark of the last sweep
+# inbound SMS normally arrive through the receive_sms webhook, the sweep picks up what the webhook missed
 def process_incoming_sms():
 
     admin_user = User.objects.get(username="admin")
-    client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-    
-    # Retrieve all SMS messages sent to the central TWILIO_PHONE_NUMBER
-    incoming_sms = client.messages.list(
-        to=settings.TWILIO_PHONE_NUMBER
-    )
-    
+    client = get_twilio_client()
+    state, _ = Inbound_Watermark.objects.get_or_create(channel=Channels.SMS)
+
+    # Retrieve the SMS messages sent to the central TWILIO_PHONE_NUMBER since the last sweep
+    # (with an overlap, messages listed twice are skipped by the ingestion ledger)
+    list_params = {'to': settings.TWILIO_PHONE_NUMBER, 'page_size': SMS_LIST_PAGE_SIZE, 'limit': SMS_LIST_LIMIT}
+    if state.watermark:
+        list_params['date_sent_after'] = (
+            state.watermark - datetime.timedelta(seconds=SMS_WATERMARK_OVERLAP_SECONDS)
+        ).replace(tzinfo=datetime.timezone.utc)
+    incoming_sms = client.messages.list(**list_params)
+
     logger.info(f"{len(incoming_sms)} SMS found for number {settings.TWILIO_PHONE_NUMBER}.")
+    processed_sids = []
+    newest = None
+    complete = len(incoming_sms) < SMS_LIST_LIMIT
     for sms in incoming_sms:
+        if sms.date_sent and (newest is None or sms.date_sent > newest):
+            newest = sms.date_sent
         # Process only messages that have an inbound direction.
         if sms.direction.lower() != "inbound":
-            deletion_success = client.messages(sms.sid).delete()
-            if deletion_success:
-                logger.info(f"Outgoing SMS SID {sms.sid} successfully deleted from Twilio.")
-            else:
-                logger.warning(f"Outgoing SMS SID {sms.sid} could not be deleted from Twilio.")            
+            processed_sids.append(sms.sid)
             logger.info(f"Skipping outgoing SMS SID {sms.sid} because its direction is '{sms.direction}'.")
             continue
 
         try:
-            # Try to extract a 16-digit code from the SMS body using regex
-            code_match = re.search(r"Code:\s*(\w{16})", sms.body)
-            if code_match:
-                code = code_match.group(1)
-                # Search for the original message in the Messages table (outbox message)
-                original_message = Messages.objects.filter(
-                    message_code=code,
-                    outbox=True,
-                    inbox=False
-                ).order_by("-created").first()
-                
-                if not original_message:
-                    logger.error(f"No original message found with code {code}. SMS SID {sms.sid} skipped.")
-                    continue
-                
-                # Compose new SMS body with details from the original message
-                new_message = Messages(
-                    sender_member_id=original_message.receiver_member_id,  # Reply is sent from the original recipient
-                    receiver_member_id=original_message.sender_member_id,  # Reply is sent to the original sender
-                    title="Re: " + original_message.title,
-                    body=original_message.body,
-                    message_code=code,
-                    inbox=True,
-                    outbox=False,
-                    internal=False,
-                    is_sent_email=True,
-                    is_sent_sms=True,
-                    is_sent_whatsApp=True,
-                    message_type=MessageType.INCOMING_SMS.value,
-                    created_by=admin_user,
-                )
-                new_message.save()
-                logger.info(f"New reply message (ID: {new_message.id}) created for code {code}.")
-            else:
-                # No code found – fallback via SMS identification
-                sms_identification = Communication.objects.filter(
-                    channel=Channels.SMS,
-                    identification=sms.from_,
-                    is_active=True
-                ).first()
-                if not sms_identification:
-                    logger.error(f"No SMS Communication entry found for number {sms.from_}. SMS SID {sms.sid} skipped.")
-                    continue
-                
-                # Generate a unique fallback code
-                fallback_code = generate_unique_message_code()
-                appended_text = "\nThis message could not be assigned to any sender because the code was missing."
-                new_sms_body = sms.body + appended_text
-                new_message = Messages(
-                    sender_member_id=sms_identification.member_id,  # Use the member from the SMS communication
-                    receiver_member_id=sms_identification.member_id,  # Association via SMS communication
-                    title="Fallback SMS:" + sms.titel,
-                    body=new_sms_body,
-                    message_code=fallback_code,
-                    inbox=True,
-                    outbox=False,
-                    internal=False,
-                    is_sent_email=True,
-                    is_sent_sms=True,
-                    is_sent_whatsApp=True,
-                    message_type=MessageType.INCOMING_SMS.value,
-                    created_by=admin_user,
-                )
-                new_message.save()
-                logger.info(f"New fallback message (ID: {new_message.id}) created for number {sms.from_} (no code found).")
-            
-            # Delete the SMS from Twilio after successful processing to ensure it is only handled once
-            deletion_success = client.messages(sms.sid).delete()
-            if deletion_success:
-                logger.info(f"SMS SID {sms.sid} successfully deleted from Twilio.")
-            else:
-                logger.warning(f"SMS SID {sms.sid} could not be deleted from Twilio.")
+            if ingest_sms(sms.sid, sms.from_, sms.body, admin_user):
+                processed_sids.append(sms.sid)
         except Exception as e:
+            # keep the watermark, the next sweep lists the SMS again
+            complete = False
             logger.error(f"Error processing SMS SID {sms.sid}: {e}")
+
+    # Delete the processed SMS from Twilio to keep the message log short
+    delete_twilio_messages(client, processed_sids)
+
+    # a listing cut off by the limit keeps the watermark, the deleted SMS make room for the rest
+    if complete and newest is not None:
+        state.watermark = newest.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        state.save(update_fields=['watermark', 'modified'])
             
     logger.info("Processing of incoming SMS completed.")
 
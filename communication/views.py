@@ -1,9 +1,16 @@
+import logging
 from django.shortcuts import render
 from django.conf import settings
 from django.http import HttpResponse, HttpResponseForbidden
 from twilio.rest import Client
 from django.views.decorators.csrf import csrf_exempt
+from twilio.request_validator import RequestValidator
 from twilio.twiml.messaging_response import MessagingResponse
+from django.contrib.auth.models import User
+from django_q.tasks import async_task
+from .utils import ingest_sms
+
+logger = logging.getLogger(__name__)
 
 # Create your views here.
 # views.py
@@ -32,23 +39,30 @@ def send_sms(request):
     #return HttpResponse(f"Nachricht gesendet! SID: {message.sid}")
     return HttpResponse(f"Nachricht gesendet!")
 
+# Twilio webhook for incoming sms
+# Configure Webhook in Twilio: "A MESSAGE COMES IN" for the relevant phone number -> /comm/sms/receive/
 @csrf_exempt
 def receive_sms(request):
+    if request.method != 'POST':
+        return HttpResponse("Invalid request", status=400)
+
+    # accept only requests signed by Twilio with our auth token
+    # (behind a proxy the public url has to be set in NEIGHBOROW_TWILIO_WEBHOOK_URL)
+    validator = RequestValidator(settings.TWILIO_AUTH_TOKEN)
+    url = getattr(settings, "NEIGHBOROW_TWILIO_WEBHOOK_URL", None) or request.build_absolute_uri()
+    if not validator.validate(url, request.POST.dict(), request.headers.get('X-Twilio-Signature', '')):
+        logger.warning("Incoming sms with invalid Twilio signature rejected.")
+        return HttpResponseForbidden("Invalid signature")
+
+    # store the reply now, deleting the sms at Twilio is left to a worker;
+    # on errors the sms stays at Twilio and the reconciliation sweep picks it up
+    sid = request.POST.get('MessageSid', '')
+    try:
+        admin_user = User.objects.get(username="admin")
+        if ingest_sms(sid, request.POST.get('From', ''), request.POST.get('Body', ''), admin_user):
+            async_task('communication.tasks.delete_twilio_message_task', sid)
+    except Exception as e:
+        logger.error(f"Error processing SMS SID {sid}: {e}")
 
-# still missing: only works with external address
-# Configure Webhook in Twilio:
-# configure "A MESSAGE COMES IN" for the relevant phone number 
-
-    if request.method == 'POST':
-        # Read incoming SMS data
-        from_number = request.POST.get('From')
-        message_body = request.POST.get('Body')
-        # process the message
-        print(f"message from {from_number}: {message_body}")
-        
-        # Create a response, if desired
-        response = MessagingResponse()
-        response.message("Thank you for your mesasage!")
-        return HttpResponse(str(response), content_type='text/xml')
-    else:
-        return HttpResponse("Invalid request", status=400)
\ No newline at end of file
+    # empty answer, no reply sms is sent
+    return HttpResponse(str(MessagingResponse()), content_type='text/xml')
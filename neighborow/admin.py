@@ -3,7 +3,9 @@ from .models import (Building, Access_Code, Member,
                      AppSettings, Invitation, Messages, 
                      Communication, Borrowing_Request_Recipients, 
                      Borrowing_Request, Items_For_Loan, Items_For_Loan_Image,
-                     Condition_Log, Condition_Image, Transaction)
+                     Condition_Log, Condition_Image, Transaction,
+                     Delivery_Attempt, Message_Content, Fan_Out_Job,
+                     Inbound_Message, Inbound_Watermark)
 
 # Register your models here.
 admin.site.register(Building)
@@ -12,6 +14,7 @@ admin.site.register(Member)
 admin.site.register(AppSettings)
 admin.site.register(Invitation)
 admin.site.register(Messages)
+admin.site.register(Message_Content)
 admin.site.register(Communication)
 admin.site.register(Borrowing_Request_Recipients)
 admin.site.register(Borrowing_Request)
@@ -20,5 +23,9 @@ admin.site.register(Items_For_Loan_Image)
 admin.site.register(Condition_Log)
 admin.site.register(Condition_Image)
 admin.site.register(Transaction)
+admin.site.register(Delivery_Attempt)
+admin.site.register(Fan_Out_Job)
+admin.site.register(Inbound_Message)
+admin.site.register(Inbound_Watermark)
 
 
@@ -1,10 +1,10 @@
 from django.apps import AppConfig
-from django.core.signals import request_started
-import os
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_migrate
 import logging
 
 logger = logging.getLogger(__name__)
-setup_done = False
 
 class NeighborowConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
@@ -12,29 +12,30 @@ class NeighborowConfig(AppConfig):
 
     def ready(self):
         import neighborow.signals
-        request_started.connect(setup_schedules_once)
-
-def setup_schedules_once(sender, **kwargs):
-    global setup_done
-    if not setup_done:
-        setup_schedules()
-        setup_done = True
-
-
-def setup_schedules():
-    from django_q.models import Schedule  
-    from django_q.tasks import schedule
-
-    # Delete existing schedule
-    logger.info("Starting Setup: Delete reminders_schedule Schedule.")
-    Schedule.objects.filter(name='reminders_schedule').delete()
-
-    # Create new schedule
-    schedule(
-        'neighborow.tasks.process_transaction_reminders',  
-        name='reminders_schedule',       
-        schedule_type=Schedule.MINUTES,     
-        minutes=10,
+        # schedules are provisioned by migrate (deploy), never in the request path
+        post_migrate.connect(setup_schedules, sender=self)
+
+
+# create the reminder sweep schedule or update it in place, arm the reminders of open transactions
+def setup_schedules(using=DEFAULT_DB_ALIAS, **kwargs):
+    from django_q.models import Schedule
+    from .models import Transaction
+    from .polling import tables_exist, upsert_schedule
+    from .reminders import schedule_missing_transaction_reminders
+
+    if not tables_exist(using, Schedule, Transaction):
+        logger.info("Setup skipped: django_q or neighborow is not migrated.")
+        return
+
+    # reminders are sent by one-shot schedules per transaction, this sweep only catches lost ones
+    upsert_schedule(
+        'reminders_schedule',
+        'neighborow.tasks.process_transaction_reminders',
+        schedule_type=Schedule.MINUTES,
+        minutes=getattr(settings, "NEIGHBOROW_REMINDER_SWEEP_MINUTES", 10),
         repeats=-1,
     )
-    logger.info("reminders_schedule Schedule created!")
+    # loans opened before the one-shot schedules existed get theirs on deploy
+    armed = schedule_missing_transaction_reminders()
+    if armed:
+        logger.info("Reminder schedules armed for %s open transactions", armed)
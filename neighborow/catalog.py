@@ -0,0 +1,115 @@
+import hashlib
+import logging
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from .models import Items_For_Loan, Member
+
+# cache of the item list pages of a building: items change rarely compared with the list reads
+# the keys of a building carry its version number, a change of an item, image, transaction or
+# member of the building moves the version on, so the old pages are never read again (they expire)
+# the rows are shared by all members of the building, the user_member_* columns are set per request
+
+logger = logging.getLogger(__name__)
+
+CATALOG_CACHE = getattr(settings, "NEIGHBOROW_CATALOG_CACHE", "default")
+CATALOG_CACHE_SECONDS = getattr(settings, "NEIGHBOROW_CATALOG_CACHE_SECONDS", 600)
+
+CATALOG_HITS_KEY = "neighborow:catalog:hits"
+CATALOG_MISSES_KEY = "neighborow:catalog:misses"
+
+
+def get_catalog_cache():
+    return caches[CATALOG_CACHE]
+
+def get_version_key(building_id):
+    return f"neighborow:catalog:{building_id}:version"
+
+# current version of a building, a lost version key starts at the clock so no old page is reused
+def get_catalog_version(cache, building_id):
+    key = get_version_key(building_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+# key of one page: the request part is hashed (timestamps and search strings are no safe key characters)
+def get_page_key(building_id, version, page_size, cursor, search_string):
+    request_hash = hashlib.sha1(repr((page_size, cursor, search_string)).encode()).hexdigest()
+    return f"neighborow:catalog:{building_id}:{version}:{request_hash}"
+
+def count(cache, key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+# hit and miss counters of all web workers
+def get_catalog_stats():
+    cache = get_catalog_cache()
+    stats = cache.get_many([CATALOG_HITS_KEY, CATALOG_MISSES_KEY])
+    hits = stats.get(CATALOG_HITS_KEY, 0)
+    misses = stats.get(CATALOG_MISSES_KEY, 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / (hits + misses) if hits + misses else None,
+    }
+
+def reset_catalog_stats():
+    get_catalog_cache().delete_many([CATALOG_HITS_KEY, CATALOG_MISSES_KEY])
+
+
+# one page of the item list of the member's building (see ItemsForLoanManager.get_items_for_loan_page)
+# read from the cache, the database is only queried on a miss; without a cache the page comes from the database
+def get_catalog_page(member, page_size, cursor=None, search_string=None):
+    building_id = member.building_id_id
+    cache = get_catalog_cache()
+    page = key = None
+    try:
+        key = get_page_key(building_id, get_catalog_version(cache, building_id), page_size, cursor, search_string)
+        page = cache.get(key)
+        count(cache, CATALOG_HITS_KEY if page is not None else CATALOG_MISSES_KEY)
+    except Exception as e:
+        logger.warning(f"Catalog cache not available: {e}")
+
+    if page is None:
+        page = Items_For_Loan.custom_objects.get_items_for_loan_page(member.id, page_size, cursor, search_string)
+        if key is not None:
+            try:
+                cache.set(key, page, CATALOG_CACHE_SECONDS)
+            except Exception as e:
+                logger.warning(f"Catalog cache not available: {e}")
+
+    items, has_next = page
+    viewer = {'user_member_id': member.id, 'user_member_nickname': member.nickname, 'user_member_flat_no': member.flat_no}
+    return [{**item, **viewer} for item in items], has_next
+
+
+# move the version of a building on
+def bump_catalog_version(building_id):
+    cache = get_catalog_cache()
+    try:
+        cache.incr(get_version_key(building_id))
+    except ValueError:
+        # no version yet: nothing cached under the old one
+        pass
+    except Exception as e:
+        logger.warning(f"Catalog cache not available: {e}")
+
+# invalidate the pages of a building at once and again after the commit
+# (a page read between both could still hold the data before the change)
+def invalidate_catalog(building_id):
+    if building_id is None:
+        return
+    bump_catalog_version(building_id)
+    transaction.on_commit(lambda: bump_catalog_version(building_id))
+
+def invalidate_member_catalog(member_id):
+    invalidate_catalog(Member.objects.filter(id=member_id).values_list('building_id', flat=True).first())
+
+def invalidate_item_catalog(item_id):
+    invalidate_catalog(Items_For_Loan.objects.filter(id=item_id).values_list('member_id__building_id', flat=True).first())
@@ -0,0 +1,168 @@
+from django.conf import settings
+from django.db import transaction
+from .models import (Borrowing_Request_Recipients, Fan_Out_Job, FanOutStatus, Member,
+                     Messages, Message_Content, MessageType)
+from .polling import wake_dispatcher
+from .utils import generate_unique_message_codes
+
+FANOUT_CHUNK_SIZE = getattr(settings, "NEIGHBOROW_FANOUT_CHUNK_SIZE", 500)
+
+
+# return the message content of a borrowing request, created with the first recipient
+def get_borrowing_request_content(borrowing_request, user):
+    if borrowing_request.content_id_id is None:
+        # Append borrowing period information if set
+        body = borrowing_request.body
+        if borrowing_request.required_from or borrowing_request.required_until:
+            body += (
+                f"\nRequired borrowing period from {borrowing_request.required_from} "
+                f"to {borrowing_request.required_until}"
+            )
+        borrowing_request.content_id = Message_Content.objects.create(
+            title=borrowing_request.title,
+            body=body,
+            created_by=user
+        )
+        borrowing_request.save(update_fields=['content_id'])
+    return borrowing_request.content_id
+
+# outbox message (waiting for delivery) and inbox message of one recipient
+def build_message_pair(sender, receiver_id, content, message_code, message_type, message_type_id, user, internal):
+    outbox_message = Messages(
+        sender_member_id=sender,
+        receiver_member_id_id=receiver_id,
+        title='',
+        body='',
+        content_id=content,
+        message_code=message_code,
+        inbox=False,
+        outbox=True,
+        internal=False,
+        is_sent_email=False,
+        is_sent_sms=False,
+        is_sent_whatsApp=False,
+        message_type=message_type,
+        message_type_id=message_type_id,
+        created_by=user
+    )
+    inbox_message = Messages(
+        sender_member_id=sender,
+        receiver_member_id_id=receiver_id,
+        title='',
+        body='',
+        content_id=content,
+        message_code=message_code,
+        inbox=True,
+        outbox=False,
+        internal=internal,
+        is_sent_email=True,
+        is_sent_sms=True,
+        is_sent_whatsApp=True,
+        message_type=message_type,
+        message_type_id=message_type_id,
+        created_by=user
+    )
+    return [outbox_message, inbox_message]
+
+# create recipients and messages of a borrowing request with a few bulk inserts
+# (same rows as the create_messages signal writes for single recipients)
+def fan_out_borrowing_request(borrowing_request, recipient_ids, user):
+    sender = borrowing_request.member_id
+    content = get_borrowing_request_content(borrowing_request, sender.user_id)
+
+    recipients = Borrowing_Request_Recipients.objects.bulk_create([
+        Borrowing_Request_Recipients(
+            member_id_id=recipient_id,
+            borrowing_request=borrowing_request,
+            created_by=user
+        )
+        for recipient_id in recipient_ids
+    ])
+
+    message_codes = generate_unique_message_codes(len(recipients))
+    messages = []
+    for recipient, message_code in zip(recipients, message_codes):
+        messages += build_message_pair(
+            sender, recipient.member_id_id, content, message_code,
+            MessageType.BORREQ.value, recipient.pk, sender.user_id, internal=True
+        )
+    Messages.objects.bulk_create(messages)
+    return recipients
+
+# create the outbox and inbox messages of a free message with a few bulk inserts
+def fan_out_free_message(sender, recipient_ids, content, user):
+    message_codes = generate_unique_message_codes(len(recipient_ids))
+    messages = []
+    for recipient_id, message_code in zip(recipient_ids, message_codes):
+        messages += build_message_pair(
+            sender, recipient_id, content, message_code,
+            MessageType.FREE_MESSAGE.value, None, user, internal=False
+        )
+    return Messages.objects.bulk_create(messages)
+
+# record a fan-out job and hand it to a django-q worker once the surrounding transaction commits
+def enqueue_fan_out(**fields):
+    from django_q.tasks import async_task
+
+    job = Fan_Out_Job.objects.create(**fields)
+    transaction.on_commit(lambda: async_task('neighborow.tasks.process_fan_out_job', job.id))
+    return job
+
+# recipients of a job in the order they were chosen, without duplicates
+# chosen ids are members of the sender's building, others (deleted members, forged posts) are skipped
+def get_fan_out_recipient_ids(job):
+    building_members = Member.objects.filter(building_id=job.sender_member_id.building_id)
+    if job.all_recipients:
+        return list(building_members.order_by('id').values_list('id', flat=True))
+    recipient_ids = list(dict.fromkeys(int(recipient_id) for recipient_id in job.recipient_ids))
+    known_ids = set(building_members.filter(id__in=recipient_ids).values_list('id', flat=True))
+    return [recipient_id for recipient_id in recipient_ids if recipient_id in known_ids]
+
+# recipients that already got their messages from an earlier (interrupted) run
+def get_fan_out_done_ids(job):
+    if job.message_type == MessageType.BORREQ:
+        done = Borrowing_Request_Recipients.objects.filter(
+            borrowing_request=job.borrowing_request_id
+        ).values_list('member_id', flat=True)
+    else:
+        done = Messages.objects.filter(
+            content_id=job.content_id_id, outbox=True
+        ).values_list('receiver_member_id', flat=True)
+    return set(done)
+
+# write the messages of a job in chunks, each chunk commits and updates the progress
+# running a job again only writes the messages of the recipients that are still missing
+def run_fan_out_job(job_id):
+    job = Fan_Out_Job.objects.select_related('sender_member_id', 'borrowing_request', 'content_id', 'created_by').get(pk=job_id)
+    if job.status == FanOutStatus.DONE:
+        return job
+    recipient_ids = get_fan_out_recipient_ids(job)
+    job.total = len(recipient_ids)
+    job.status = FanOutStatus.RUNNING
+    job.save(update_fields=['total', 'status', 'modified'])
+
+    try:
+        while True:
+            with transaction.atomic():
+                # lock the job, a second worker running the same job waits for this chunk
+                Fan_Out_Job.objects.select_for_update().get(pk=job.pk)
+                done = get_fan_out_done_ids(job)
+                remaining = [recipient_id for recipient_id in recipient_ids if recipient_id not in done]
+                chunk = remaining[:FANOUT_CHUNK_SIZE]
+                if chunk:
+                    if job.message_type == MessageType.BORREQ:
+                        fan_out_borrowing_request(job.borrowing_request, chunk, job.created_by)
+                    else:
+                        fan_out_free_message(job.sender_member_id, chunk, job.content_id, job.created_by)
+                    # delivery of the chunk starts while the next one is written
+                    wake_dispatcher()
+                job.processed = job.total - len(remaining) + len(chunk)
+                job.status = FanOutStatus.RUNNING if len(remaining) > len(chunk) else FanOutStatus.DONE
+                job.save(update_fields=['processed', 'status', 'modified'])
+            if job.status == FanOutStatus.DONE:
+                return job
+    except Exception as e:
+        job.status = FanOutStatus.FAILED
+        job.last_error = str(e)[:500]
+        job.save(update_fields=['status', 'last_error', 'modified'])
+        raise
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from neighborow.catalog import get_catalog_stats, reset_catalog_stats
+
+
+class Command(BaseCommand):
+    help = "Show the hit and miss counters of the item catalog cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="set the counters back to zero")
+
+    def handle(self, *args, **options):
+        stats = get_catalog_stats()
+        hit_rate = f"{stats['hit_rate']:.1%}" if stats['hit_rate'] is not None else "-"
+        self.stdout.write(f"hits: {stats['hits']}, misses: {stats['misses']}, hit rate: {hit_rate}")
+        if options['reset']:
+            reset_catalog_stats()
+            self.stdout.write("Counters reset.")
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.7 on 2026-10-17 11:48
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('neighborow', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messages',
+            name='claim_token',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='messages',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='messages',
+            index=models.Index(fields=['claim_token'], name='neighborow__claim_t_298c0f_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-17 11:53
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('neighborow', '0002_messages_outbox_claim'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='messages',
+            index=models.Index(condition=models.Q(models.Q(('is_sent_email', False), ('is_sent_sms', False), ('is_sent_whatsApp', False), _connector='OR'), ('inbox', False), ('outbox', True)), fields=['id'], name='messages_pending_delivery_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messages',
+            index=models.Index(condition=models.Q(('inbox', True), ('internal', True), _connector='OR'), fields=['receiver_member_id', '-created'], name='messages_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messages',
+            index=models.Index(condition=models.Q(('outbox', True)), fields=['sender_member_id', '-created'], name='messages_outbox_idx'),
+        ),
+    ]
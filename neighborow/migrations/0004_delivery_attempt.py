@@ -0,0 +1,60 @@
+# Generated by Django 5.1.7 on 2026-10-17 11:54
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('neighborow', '0003_messages_delivery_inbox_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Delivery_Attempt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(choices=[('0', 'built-in messages'), ('1', 'email'), ('2', 'text messages'), ('3', 'WhatsApp')], default='1', max_length=2)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.CharField(blank=True, default='', max_length=500)),
+                ('is_dead_letter', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='messages',
+            name='messages_pending_delivery_idx',
+        ),
+        migrations.AddField(
+            model_name='messages',
+            name='is_dead_letter',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='messages',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='messages',
+            index=models.Index(condition=models.Q(models.Q(('is_sent_email', False), ('is_sent_sms', False), ('is_sent_whatsApp', False), _connector='OR'), ('inbox', False), ('is_dead_letter', False), ('outbox', True)), fields=['id'], name='messages_pending_delivery_idx'),
+        ),
+        migrations.AddField(
+            model_name='delivery_attempt',
+            name='message_id',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='delivery_attempts', to='neighborow.messages'),
+        ),
+        migrations.AddIndex(
+            model_name='delivery_attempt',
+            index=models.Index(fields=['is_dead_letter'], name='neighborow__is_dead_31eedc_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='delivery_attempt',
+            constraint=models.UniqueConstraint(fields=('message_id', 'channel'), name='unique_delivery_attempt_message_id_channel'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.7 on 2026-10-17 12:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('neighborow', '0005_message_content'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Fan_Out_Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_type', models.CharField(choices=[('0', 'Undefined'), ('1', 'Other'), ('2', 'Internal'), ('3', 'Borrowing Request'), ('4', 'Reply Inbox/Item List'), ('5', 'Reply Mail'), ('6', 'Incoming SMS'), ('7', 'Free Message'), ('8', 'Reminder')], default='7', max_length=2)),
+                ('all_recipients', models.BooleanField(default=False)),
+                ('recipient_ids', models.JSONField(blank=True, default=list)),
+                ('status', models.CharField(choices=[('0', 'Pending'), ('1', 'Running'), ('2', 'Done'), ('3', 'Failed')], default='0', max_length=2)),
+                ('total', models.IntegerField(default=0)),
+                ('processed', models.IntegerField(default=0)),
+                ('last_error', models.CharField(blank=True, default='', max_length=500)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('borrowing_request', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='neighborow.borrowing_request')),
+                ('content_id', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='neighborow.message_content')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='created_%(class)s_set', to=settings.AUTH_USER_MODEL)),
+                ('sender_member_id', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fan_out_jobs', to='neighborow.member')),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-17 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('neighborow', '0006_fan_out_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Inbound_Message',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(choices=[('0', 'built-in messages'), ('1', 'email'), ('2', 'text messages'), ('3', 'WhatsApp')], default='1', max_length=2)),
+                ('external_id', models.CharField(max_length=255)),
+                ('claim_token', models.UUIDField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['claim_token'], name='neighborow__claim_t_f57c08_idx')],
+                'constraints': [models.UniqueConstraint(fields=('channel', 'external_id'), name='unique_inbound_message_channel_external_id')],
+            },
+        ),
+    ]
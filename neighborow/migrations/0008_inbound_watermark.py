@@ -0,0 +1,22 @@
+# Generated by Django 5.1.7 on 2026-10-17 12:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('neighborow', '0007_inbound_message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Inbound_Watermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(choices=[('0', 'built-in messages'), ('1', 'email'), ('2', 'text messages'), ('3', 'WhatsApp')], default='2', max_length=2, unique=True)),
+                ('watermark', models.DateTimeField(blank=True, null=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-17 13:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('neighborow', '0008_inbound_watermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inbound_watermark',
+            name='last_uid',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='inbound_watermark',
+            name='uid_validity',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
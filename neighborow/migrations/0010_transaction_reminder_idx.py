@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-17 13:32
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('neighborow', '0009_inbound_watermark_uid'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['return_date', 'borrowed_until', 'reminder'], name='transaction_reminder_idx'),
+        ),
+    ]
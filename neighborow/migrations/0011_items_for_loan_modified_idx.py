@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-17 13:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('neighborow', '0010_transaction_reminder_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='items_for_loan',
+            index=models.Index(fields=['modified', 'id'], name='items_for_loan_modified_idx'),
+        ),
+    ]
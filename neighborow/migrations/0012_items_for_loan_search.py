@@ -0,0 +1,95 @@
+from django.db import migrations
+
+# full-text search index of the items for loan (see neighborow.search)
+# PostgreSQL: generated tsvector column with a GIN index and a pg_trgm index for substrings
+# SQLite: FTS5 table with the trigram tokenizer, kept in sync by triggers
+
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """
+    ALTER TABLE neighborow_items_for_loan ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(label, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(description, '')), 'B')
+        ) STORED
+    """,
+    "CREATE INDEX items_for_loan_search_idx ON neighborow_items_for_loan USING GIN (search_vector)",
+    """
+    CREATE INDEX items_for_loan_trgm_idx ON neighborow_items_for_loan
+        USING GIN ((lower(label || ' ' || description)) gin_trgm_ops)
+    """,
+]
+
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS items_for_loan_trgm_idx",
+    "DROP INDEX IF EXISTS items_for_loan_search_idx",
+    "ALTER TABLE neighborow_items_for_loan DROP COLUMN IF EXISTS search_vector",
+]
+
+# SQLite drops the triggers when a later migration rebuilds neighborow_items_for_loan,
+# such a migration has to create them again
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS neighborow_items_for_loan_fts_insert AFTER INSERT ON neighborow_items_for_loan BEGIN
+        INSERT INTO neighborow_items_for_loan_fts(rowid, label, description)
+        VALUES (new.id, new.label, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS neighborow_items_for_loan_fts_delete AFTER DELETE ON neighborow_items_for_loan BEGIN
+        INSERT INTO neighborow_items_for_loan_fts(neighborow_items_for_loan_fts, rowid, label, description)
+        VALUES ('delete', old.id, old.label, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS neighborow_items_for_loan_fts_update AFTER UPDATE OF label, description ON neighborow_items_for_loan BEGIN
+        INSERT INTO neighborow_items_for_loan_fts(neighborow_items_for_loan_fts, rowid, label, description)
+        VALUES ('delete', old.id, old.label, old.description);
+        INSERT INTO neighborow_items_for_loan_fts(rowid, label, description)
+        VALUES (new.id, new.label, new.description);
+    END
+    """,
+]
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE neighborow_items_for_loan_fts USING fts5(
+        label, description,
+        content='neighborow_items_for_loan', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    *SQLITE_TRIGGERS,
+    "INSERT INTO neighborow_items_for_loan_fts(neighborow_items_for_loan_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS neighborow_items_for_loan_fts_update",
+    "DROP TRIGGER IF EXISTS neighborow_items_for_loan_fts_delete",
+    "DROP TRIGGER IF EXISTS neighborow_items_for_loan_fts_insert",
+    "DROP TABLE IF EXISTS neighborow_items_for_loan_fts",
+]
+
+
+def run_statements(schema_editor, statements):
+    statements = statements.get(schema_editor.connection.vendor, [])
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def create_search_index(apps, schema_editor):
+    run_statements(schema_editor, {'postgresql': POSTGRES_FORWARD, 'sqlite': SQLITE_FORWARD})
+
+
+def drop_search_index(apps, schema_editor):
+    run_statements(schema_editor, {'postgresql': POSTGRES_REVERSE, 'sqlite': SQLITE_REVERSE})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('neighborow', '0011_items_for_loan_modified_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.1.7 on 2026-10-17 13:57
+
+import importlib
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Min
+
+# the new columns are nullable without a default, so SQLite adds them with ALTER TABLE
+# instead of rebuilding the table (a rebuild drops the search triggers of 0012),
+# removing them does rebuild it, the reverse migration creates the triggers again
+search_migration = importlib.import_module('neighborow.migrations.0012_items_for_loan_search')
+
+
+def restore_search_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in search_migration.SQLITE_TRIGGERS:
+            schema_editor.execute(statement)
+
+
+# first image of every item that has images
+def backfill_primary_image(apps, schema_editor):
+    Items_For_Loan = apps.get_model('neighborow', 'Items_For_Loan')
+    Items_For_Loan_Image = apps.get_model('neighborow', 'Items_For_Loan_Image')
+
+    first_ids = Items_For_Loan_Image.objects.values('items_for_loan_id').annotate(first_id=Min('id')).values('first_id')
+    items = []
+    for image in Items_For_Loan_Image.objects.filter(id__in=first_ids).iterator(chunk_size=1000):
+        items.append(Items_For_Loan(
+            id=image.items_for_loan_id_id,
+            primary_image_id=image.id,
+            primary_image_url=image.image.name,
+            primary_image_caption=image.caption,
+        ))
+    Items_For_Loan.objects.bulk_update(
+        items, ['primary_image', 'primary_image_url', 'primary_image_caption'], batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('neighborow', '0012_items_for_loan_search'),
+    ]
+
+    operations = [
+        # reverse runs last, after the table has been rebuilt
+        migrations.RunPython(migrations.RunPython.noop, restore_search_triggers),
+        migrations.AddField(
+            model_name='items_for_loan',
+            name='primary_image',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='neighborow.items_for_loan_image'),
+        ),
+        migrations.AddField(
+            model_name='items_for_loan',
+            name='primary_image_caption',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='items_for_loan',
+            name='primary_image_url',
+            field=models.CharField(blank=True, editable=False, max_length=100, null=True),
+        ),
+        migrations.RunPython(backfill_primary_image, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,10 @@
 import datetime
+import uuid
 from django.db import models
-from django.db.models import UniqueConstraint
+from django.db.models import Min, Q, UniqueConstraint
 from django.contrib.auth.models import User
-from django.db import connection
+from django.db import connection, transaction
+from django.utils import timezone
 
 
 # Create your models here.
@@ -40,6 +42,12 @@ class MessageType(models.TextChoices):
     FREE_MESSAGE = '7', 'Free Message'
     REMINDER = '8', 'Reminder'
 
+class FanOutStatus(models.TextChoices):
+    PENDING = '0', 'Pending'
+    RUNNING = '1', 'Running'
+    DONE = '2', 'Done'
+    FAILED = '3', 'Failed'
+
 class ReminderType(models.TextChoices):
     STANDARD = '0', 'Standard'
     REMINDER_DAY = '1', 'Reminder 1 Day'
@@ -175,6 +183,61 @@ class Invitation(models.Model):
         ]
 
 
+class Message_Content(models.Model):
+    # title and body shared by all inbox/outbox rows of one broadcast
+    title = models.CharField(max_length=175, null=False, blank=False)
+    body = models.CharField(max_length=2100, null=False, blank=False)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='created_%(class)s_set')
+    created = models.DateTimeField(auto_now_add=True)
+    modified_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='modified_%(class)s_set')
+    modified = models.DateTimeField(auto_now=True)
+
+    objects = models.Manager()
+
+    def __str__(self):
+        return f"{self.id}"
+
+
+class MessagesManager(models.Manager):
+    # all outbox messages waiting for delivery on at least one channel
+    def pending_delivery(self):
+        return self.filter(
+            Q(is_sent_email=False) | Q(is_sent_sms=False) | Q(is_sent_whatsApp=False),
+            outbox=True,
+            inbox=False,
+            is_dead_letter=False
+        )
+
+    # lease a chunk of pending messages for one dispatcher run, returns claim token and messages
+    def claim_pending_delivery(self, batch_size, lease_seconds, after_id=0):
+        claim_token = uuid.uuid4()
+        now = timezone.now()
+        unclaimed = Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+        # messages with failed deliveries wait until their next attempt is due
+        due = Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now)
+        with transaction.atomic():
+            candidates = self.pending_delivery().filter(unclaimed, due, id__gt=after_id).order_by('id')
+            if connection.features.has_select_for_update_skip_locked:
+                # PostgreSQL: rows locked by another dispatcher are skipped instead of waited for
+                candidates = candidates.select_for_update(skip_locked=True)
+            candidate_ids = list(candidates.values_list('id', flat=True)[:batch_size])
+            # conditional update: without row locks (SQLite) only rows still unclaimed are taken
+            self.filter(unclaimed, id__in=candidate_ids).update(
+                claim_token=claim_token,
+                claimed_until=now + datetime.timedelta(seconds=lease_seconds)
+            )
+        return claim_token, list(self.filter(claim_token=claim_token).select_related('content_id').order_by('id'))
+
+    # give leased messages back to the pool
+    def release_claim(self, claim_token):
+        return self.filter(claim_token=claim_token).update(claim_token=None, claimed_until=None)
+
+    # earliest future retry of a pending message with failed deliveries, None if there is none
+    def next_retry_at(self):
+        return self.pending_delivery().filter(next_attempt_at__gt=timezone.now()).aggregate(
+            next_retry=Min('next_attempt_at'))['next_retry']
+
+
 class Messages(models.Model):
     sender_member_id = models.ForeignKey(Member, on_delete=models.CASCADE, related_name="message_sender")
     receiver_member_id = models.ForeignKey(Member, on_delete=models.CASCADE, related_name="message_receiver")
@@ -191,6 +254,14 @@ class Messages(models.Model):
                              choices=MessageType.choices,
                              default=MessageType.UNDEFINED)
     message_type_id = models.BigIntegerField(null=True, blank=True)
+    # broadcast rows keep title and body only once in the shared content (own title and body stay empty)
+    content_id = models.ForeignKey(Message_Content, on_delete=models.CASCADE, related_name="messages", null=True, blank=True)
+    # outbox lease of the dispatcher run currently delivering this message
+    claim_token = models.UUIDField(null=True, blank=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    # retry state of failed deliveries, details per channel in Delivery_Attempt
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    is_dead_letter = models.BooleanField(default=False)
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='created_%(class)s_set')
     created = models.DateTimeField(auto_now_add=True)
     modified_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='modified_%(class)s_set')
@@ -201,15 +272,106 @@ class Messages(models.Model):
             models.Index(fields=["sender_member_id"]),
             models.Index(fields=["receiver_member_id"]),
             models.Index(fields=["message_code"]),
+            models.Index(fields=["claim_token"]),
+            # dispatcher: outbox rows still waiting for delivery (walked by id)
+            models.Index(fields=["id"], name="messages_pending_delivery_idx",
+                         condition=(Q(is_sent_email=False) | Q(is_sent_sms=False) | Q(is_sent_whatsApp=False))
+                                   & Q(outbox=True, inbox=False, is_dead_letter=False)),
+            # inbox widget: receiver with inbox or internal flag, newest first
+            models.Index(fields=["receiver_member_id", "-created"], name="messages_inbox_idx",
+                         condition=Q(inbox=True) | Q(internal=True)),
+            # outbox widget: sender with outbox flag, newest first
+            models.Index(fields=["sender_member_id", "-created"], name="messages_outbox_idx",
+                         condition=Q(outbox=True)),
             ]
 
     objects = models.Manager()
+    custom_objects = MessagesManager()
 
     def __str__(self):
         return f"{self.id}"
+
+    # title of the message, read from the shared content for broadcast rows
+    @property
+    def subject(self):
+        return self.content_id.title if self.content_id_id else self.title
+
+    # body of the message, read from the shared content for broadcast rows
+    @property
+    def text(self):
+        return self.content_id.body if self.content_id_id else self.body
     
 
 
+class Delivery_Attempt(models.Model):
+    # failed deliveries of an outbox message on one channel
+    message_id = models.ForeignKey(Messages, on_delete=models.CASCADE, related_name="delivery_attempts")
+    channel = models.CharField(max_length=2, null=False, blank=False,
+                             choices=Channels.choices,
+                             default=Channels.EMAIL)
+    attempts = models.IntegerField(null=False, blank=False, default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.CharField(max_length=500, null=False, blank=True, default='')
+    is_dead_letter = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["is_dead_letter"]),
+            ]
+        constraints = [
+            UniqueConstraint(fields=['message_id', 'channel'], name='unique_delivery_attempt_message_id_channel')
+        ]
+
+    objects = models.Manager()
+
+    def __str__(self):
+        return f"{self.id}"
+
+
+class Inbound_Message(models.Model):
+    # ledger of received mails (Message-ID) and text messages (Twilio SID), each one is ingested once
+    channel = models.CharField(max_length=2, null=False, blank=False,
+                             choices=Channels.choices,
+                             default=Channels.EMAIL)
+    external_id = models.CharField(max_length=255, null=False, blank=False)
+    # run that ingested the message
+    claim_token = models.UUIDField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["claim_token"]),
+            ]
+        constraints = [
+            UniqueConstraint(fields=['channel', 'external_id'], name='unique_inbound_message_channel_external_id')
+        ]
+
+    objects = models.Manager()
+
+    def __str__(self):
+        return f"{self.id}"
+
+
+class Inbound_Watermark(models.Model):
+    # newest message a polling sweep or listener has seen, the next run only fetches newer messages
+    # (SMS: send date in UTC, email: IMAP UID)
+    channel = models.CharField(max_length=2, null=False, blank=False, unique=True,
+                             choices=Channels.choices,
+                             default=Channels.SMS)
+    watermark = models.DateTimeField(null=True, blank=True)
+    # IMAP listener: highest UID fetched and the UIDVALIDITY of the folder it belongs to
+    last_uid = models.BigIntegerField(null=True, blank=True)
+    uid_validity = models.BigIntegerField(null=True, blank=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    objects = models.Manager()
+
+    def __str__(self):
+        return f"{self.id}"
+
+
 class Communication(models.Model):
     member_id = models.ForeignKey(Member, on_delete=models.CASCADE)
     channel = models.CharField(max_length=2, null=False, blank=False,
@@ -243,6 +405,8 @@ class Borrowing_Request(models.Model):
     body = models.CharField(max_length=2000, null=False, blank=False)
     required_from = models.DateTimeField(blank=True, null=True)
     required_until = models.DateTimeField(blank=True, null=True)
+    # message content shared by the messages to all recipients
+    content_id = models.ForeignKey(Message_Content, on_delete=models.SET_NULL, null=True, blank=True)
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='created_%(class)s_set')
     created = models.DateTimeField(auto_now_add=True)
     modified_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='modified_%(class)s_set')
@@ -283,50 +447,44 @@ class Borrowing_Request_Recipients(models.Model):
     def __str__(self):
         return f"{self.id}"
 
-class ItemsForLoanManager(models.Manager):
-    # return details for each item
-    def get_items_for_loan(self, member_id):
-        with connection.cursor() as cursor:
-            cursor.execute("""
-                            SELECT  i.id,
-                                    i.label,
-                                    i.description,
-                                    i.available_from,
-                                    i.currently_borrowed,
-                                    i.available,
-                                    i.created,
-                                    i.modified,
-                                    i.created_by_id,
-                                    i.member_id_id,
-                                    i.modified_by_id,
-                                    m.id as lender_member_id,
-                                    m.nickname as lender_member_nickname,
-                                    m.flat_no as lender_member_flat_no,
-                                    u.id as user_member_id,
-                                    u.nickname as user_member_nickname,
-                                    u.flat_no as user_member_flat_no,
-                                    g.id as image_id,
-                                    g.image as image_url,
-                                    g.caption as image_caption
-                            FROM neighborow_items_for_loan as i
-                            INNER JOIN neighborow_member as m ON m.id = i.member_id_id
-                            INNER JOIN neighborow_member as u ON u.id = %s
-                            LEFT OUTER JOIN neighborow_items_for_loan_image as g on g.items_for_loan_id_id = i.id
-                                            and g.id = (Select min(id) from neighborow_items_for_loan_image g2 where g2.items_for_loan_id_id = g.items_for_loan_id_id)
-                            WHERE m.building_id_id = u.building_id_id
-                            AND i.available = true
-                            and i.is_deleted = false
-                            order by i.modified DESC
-                            """, [member_id])
-            columns = [col[0] for col in cursor.description]
-            results = [dict(zip(columns, row)) for row in cursor.fetchall()]
-            return results
+class Fan_Out_Job(models.Model):
+    # broadcast (borrowing request or free message) whose recipient messages are written by a django-q task
+    message_type = models.CharField(max_length=2, null=False, blank=False,
+                             choices=MessageType.choices,
+                             default=MessageType.FREE_MESSAGE)
+    sender_member_id = models.ForeignKey(Member, on_delete=models.CASCADE, related_name="fan_out_jobs")
+    borrowing_request = models.ForeignKey(Borrowing_Request, on_delete=models.CASCADE, null=True, blank=True)
+    content_id = models.ForeignKey(Message_Content, on_delete=models.CASCADE, null=True, blank=True)
+    # all members of the sender's building, otherwise the selected recipient_ids
+    all_recipients = models.BooleanField(default=False)
+    recipient_ids = models.JSONField(default=list, blank=True)
+    status = models.CharField(max_length=2, null=False, blank=False,
+                             choices=FanOutStatus.choices,
+                             default=FanOutStatus.PENDING)
+    total = models.IntegerField(null=False, blank=False, default=0)
+    processed = models.IntegerField(null=False, blank=False, default=0)
+    last_error = models.CharField(max_length=500, null=False, blank=True, default='')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='created_%(class)s_set')
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
 
+    objects = models.Manager()
 
+    def __str__(self):
+        return f"{self.id}"
 
-    def get_filtered_items_for_loan(self, member_id, search_string):
-        search_pattern = f"%{search_string}%"
-        sql = """
+class ItemsForLoanManager(models.Manager):
+    # available items of the member's building with lender, member and first image, newest first
+    # search_string: full-text search (see neighborow.search), results ordered by relevance first
+    # page_size: at most page_size + 1 rows (the extra row tells if there is a next page)
+    # cursor: sort key of the last item of the previous page, the page continues behind it:
+    # (modified, id), with a search string (search_rank, modified, id)
+    # (keyset pagination, no OFFSET: the cost of a page does not grow with its position)
+    def query_items_for_loan(self, member_id, search_string=None, page_size=None, cursor=None):
+        from .search import get_item_search
+
+        search = get_item_search().clauses(search_string) if search_string else None
+        sql = f"""
                 SELECT  i.id,
                         i.label,
                         i.description,
@@ -344,26 +502,64 @@ class ItemsForLoanManager(models.Manager):
                         u.id as user_member_id,
                         u.nickname as user_member_nickname,
                         u.flat_no as user_member_flat_no,
-                        g.id as image_id,
-                        g.image as image_url,
-                        g.caption as image_caption
+                        i.primary_image_id as image_id,
+                        i.primary_image_url as image_url,
+                        i.primary_image_caption as image_caption,
+                        {search.rank if search else "0.0"} as search_rank
                 FROM neighborow_items_for_loan as i
+                {search.join if search else ""}
                 INNER JOIN neighborow_member as m ON m.id = i.member_id_id
                 INNER JOIN neighborow_member as u ON u.id = %s
-                LEFT OUTER JOIN neighborow_items_for_loan_image as g on g.items_for_loan_id_id = i.id
-                                and g.id = (Select min(id) from neighborow_items_for_loan_image g2 where g2.items_for_loan_id_id = g.items_for_loan_id_id)
                 WHERE m.building_id_id = u.building_id_id
                 AND i.available = true
                 and i.is_deleted = false
-                AND (LOWER(i.label) LIKE LOWER(%s) OR LOWER(i.description) LIKE LOWER(%s))
-                order by i.modified DESC
                 """
-        
-        with connection.cursor() as cursor:
-            cursor.execute(sql, [member_id, search_pattern, search_pattern])
-            columns = [col[0] for col in cursor.description]
-            results = [dict(zip(columns, row)) for row in cursor.fetchall()]
-            return results
+        params = (search.rank_params + search.join_params if search else []) + [member_id]
+        if search:
+            sql += f" AND {search.where}"
+            params += search.where_params
+            if cursor is not None:
+                search_rank, modified, item_id = cursor
+                sql += f" AND ({search.rank}, i.modified, i.id) < (%s, %s, %s)"
+                params += search.rank_params + [search_rank, modified, item_id]
+            sql += " ORDER BY search_rank DESC, i.modified DESC, i.id DESC"
+        else:
+            if cursor is not None:
+                modified, item_id = cursor
+                sql += " AND (i.modified < %s OR (i.modified = %s AND i.id < %s))"
+                params += [modified, modified, item_id]
+            # id breaks ties between items modified at the same time
+            sql += " ORDER BY i.modified DESC, i.id DESC"
+        if page_size is not None:
+            sql += " LIMIT %s"
+            params.append(page_size + 1)
+
+        with connection.cursor() as db_cursor:
+            db_cursor.execute(sql, params)
+            columns = [col[0] for col in db_cursor.description]
+            return [dict(zip(columns, row)) for row in db_cursor.fetchall()]
+
+    # return details for each item
+    def get_items_for_loan(self, member_id):
+        return self.query_items_for_loan(member_id)
+
+    def get_filtered_items_for_loan(self, member_id, search_string):
+        return self.query_items_for_loan(member_id, search_string)
+
+    # one page of the (filtered) items for loan: (items, has next page)
+    def get_items_for_loan_page(self, member_id, page_size, cursor=None, search_string=None):
+        items = self.query_items_for_loan(member_id, search_string, page_size, cursor)
+        return items[:page_size], len(items) > page_size
+
+    # set the primary image columns of an item to its first image (none left: NULL)
+    # update() keeps modified, an image change does not move the item in the list
+    def refresh_primary_image(self, item_id):
+        image = Items_For_Loan_Image.objects.filter(items_for_loan_id=item_id).order_by('id').first()
+        return self.filter(id=item_id).update(
+            primary_image=image,
+            primary_image_url=image.image.name if image else None,
+            primary_image_caption=image.caption if image else None,
+        )
 
 
 class Items_For_Loan(models.Model):
@@ -378,10 +574,18 @@ class Items_For_Loan(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     modified_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='modified_%(class)s_set')
     modified = models.DateTimeField(auto_now=True)
+    # first image of the item (lowest id) with its file and caption, maintained by the image signals,
+    # so the lists do not look it up per row
+    # (not editable: forms and the admin never write them)
+    primary_image = models.ForeignKey('Items_For_Loan_Image', on_delete=models.SET_NULL, null=True, blank=True, editable=False, related_name='+')
+    primary_image_url = models.CharField(max_length=100, null=True, blank=True, editable=False)
+    primary_image_caption = models.CharField(max_length=255, null=True, blank=True, editable=False)
 
     class Meta:
         indexes = [
             models.Index(fields=["member_id"]),
+            # item list: newest first, keyset pagination on (modified, id)
+            models.Index(fields=["modified", "id"], name="items_for_loan_modified_idx"),
             ]
 
     objects = models.Manager()
@@ -428,6 +632,14 @@ class Condition_Image(models.Model):
 
 
 class TransactionManager(models.Manager):
+    # open transactions in one of the reminder states that are due in (after, until]
+    # (after None: all due until then), borrower, lender and item are joined for the reminder text
+    def due_for_reminder(self, reminders, after, until):
+        transactions = self.filter(return_date__isnull=True, reminder__in=reminders, borrowed_until__lte=until)
+        if after is not None:
+            transactions = transactions.filter(borrowed_until__gt=after)
+        return transactions.select_related('items_for_loan_id', 'borrower_member_id', 'lender_member_id').order_by('id')
+
     # return details borrowed items
     def get_borrowed_items(self, member_id):
         sql = """
@@ -443,17 +655,13 @@ class TransactionManager(models.Manager):
                     t.borrowed_on,
                     t.borrowed_until,
                     t.return_date,
-                    g.id as image_id,
-                    g.image as image_url,
-                    g.caption as image_caption,
+                    i.primary_image_id as image_id,
+                    i.primary_image_url as image_url,
+                    i.primary_image_caption as image_caption,
                     clb.id as before_condition_id,
 	                cla.id as after_condition_id 	   
                 FROM neighborow_transaction as t
                 INNER JOIN neighborow_Items_For_Loan as i on t.items_for_loan_id_id = i.id
-                LEFT OUTER JOIN neighborow_items_for_loan_image as g on g.items_for_loan_id_id = i.id
-                                                            and g.id = (Select min(id) 
-                                                                        from neighborow_items_for_loan_image g2 
-                                                                        where g2.items_for_loan_id_id = g.items_for_loan_id_id)
                 INNER JOIN neighborow_member as b ON b.id = t.borrower_member_id_id
                 INNER JOIN neighborow_member as l ON l.id = t.lender_member_id_id		
                 LEFT OUTER JOIN neighborow_condition_Log as clb on clb.id = t.before_condition_id
@@ -482,17 +690,13 @@ class TransactionManager(models.Manager):
                     t.borrowed_on,
                     t.borrowed_until,
                     t.return_date,
-                    g.id as image_id,
-                    g.image as image_url,
-                    g.caption as image_caption,
+                    i.primary_image_id as image_id,
+                    i.primary_image_url as image_url,
+                    i.primary_image_caption as image_caption,
                     clb.id as before_condition_id,
 	                cla.id as after_condition_id   
                 FROM neighborow_transaction as t
                 INNER JOIN neighborow_Items_For_Loan as i on t.items_for_loan_id_id = i.id
-                LEFT OUTER JOIN neighborow_items_for_loan_image as g on g.items_for_loan_id_id = i.id
-                                                            and g.id = (Select min(id) 
-                                                                        from neighborow_items_for_loan_image g2 
-                                                                        where g2.items_for_loan_id_id = g.items_for_loan_id_id)
                 INNER JOIN neighborow_member as b ON b.id = t.borrower_member_id_id
                 INNER JOIN neighborow_member as l ON l.id = t.lender_member_id_id		
                 LEFT OUTER JOIN neighborow_condition_Log as clb on clb.id = t.before_condition_id
@@ -525,6 +729,12 @@ class Transaction(models.Model):
     modified_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='modified_%(class)s_set')
     modified = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # reminder engine: open loans (return_date null) by due date and reminder state
+            models.Index(fields=["return_date", "borrowed_until", "reminder"], name="transaction_reminder_idx"),
+            ]
+
     objects = models.Manager()
     custom_objects = TransactionManager() 
 
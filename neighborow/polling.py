@@ -0,0 +1,81 @@
+import datetime
+import logging
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+# adaptive cadence of the polling schedules: a run that found work is scheduled again at once
+# (the django-q scheduler starts it on its next cycle), idle runs double the interval up to a ceiling
+# the minutes field of the schedule holds the current idle interval
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_SCHEDULE = 'mail_sender_task'
+FETCH_MAILS_SCHEDULE = 'fetch_mails'
+
+POLL_MIN_MINUTES = 1
+# longest interval of an idle dispatcher, new outbox messages wake it up
+DISPATCH_POLL_MAX_MINUTES = getattr(settings, "NEIGHBOROW_DISPATCH_POLL_MAX_MINUTES", 30)
+# longest interval of an idle mail fetch (replies arrive without a wake-up)
+MAIL_POLL_MAX_MINUTES = getattr(settings, "NEIGHBOROW_MAIL_POLL_MAX_MINUTES", 8)
+
+
+# set the next run of a schedule at the end of its task
+# runs after the scheduler has saved the schedule, so this overrides the fixed cadence
+# next_due: time known work becomes due (e.g. a delivery retry), an idle run never waits past it
+def reschedule(name, found_work, max_minutes, next_due=None):
+    from django_q.models import Schedule
+
+    schedule = Schedule.objects.filter(name=name).only('id', 'minutes').first()
+    if schedule is None:
+        return None
+    now = timezone.now()
+    if found_work:
+        next_run = now
+        minutes = POLL_MIN_MINUTES
+    else:
+        current = min(max(schedule.minutes or POLL_MIN_MINUTES, POLL_MIN_MINUTES), max_minutes)
+        next_run = now + datetime.timedelta(minutes=current)
+        if next_due is not None:
+            next_run = max(now, min(next_run, next_due))
+        minutes = min(current * 2, max_minutes)
+    Schedule.objects.filter(pk=schedule.pk).update(next_run=next_run, minutes=minutes)
+    return next_run
+
+# run a backed off schedule on the next scheduler cycle and reset its interval
+def wake_schedule(name):
+    from django_q.models import Schedule
+
+    now = timezone.now()
+    Schedule.objects.filter(name=name, next_run__gt=now).update(next_run=now, minutes=POLL_MIN_MINUTES)
+
+# wake the dispatcher once the transaction that wrote outbox messages has committed
+def wake_dispatcher():
+    transaction.on_commit(lambda: wake_schedule(DISPATCH_SCHEDULE))
+
+# True if the tables of all models exist, the post_migrate setup runs after partial migrations too
+# (e.g. migrate neighborow on a fresh database, migrate neighborow zero)
+def tables_exist(using, *models):
+    table_names = set(connections[using].introspection.table_names())
+    return all(model._meta.db_table in table_names for model in models)
+
+# create or update a schedule so that it matches the desired settings, used by the post_migrate setup
+# fields in keep are only set on creation (e.g. the interval of the adaptive schedules)
+def upsert_schedule(name, func, keep=(), **fields):
+    from django_q.models import Schedule
+
+    schedules = list(Schedule.objects.filter(name=name).order_by('id'))
+    if not schedules:
+        Schedule.objects.create(name=name, func=func, **fields)
+        logger.info("%s Schedule created!", name)
+        return
+    schedule = schedules[0]
+    # duplicates left by the old startup setup of several web workers
+    Schedule.objects.filter(id__in=[duplicate.id for duplicate in schedules[1:]]).delete()
+    desired = {'func': func, **{field: value for field, value in fields.items() if field not in keep}}
+    changed = [field for field, value in desired.items() if getattr(schedule, field) != value]
+    if changed:
+        for field in changed:
+            setattr(schedule, field, desired[field])
+        schedule.save(update_fields=changed)
+        logger.info("%s Schedule updated: %s", name, ", ".join(changed))
@@ -0,0 +1,183 @@
+from datetime import timedelta
+from django.db import connection, transaction
+from django.db.models import CharField, Exists, OuterRef, Value
+from django.db.models.functions import Cast, Concat
+from django.utils import timezone
+from .models import Transaction, Messages, ReminderType, MessageType
+from .utils import generate_unique_message_codes
+from .polling import wake_dispatcher
+
+# reminders of open loans: each reminder is sent by a one-shot schedule at the time its window opens,
+# the periodic sweep (process_transaction_reminders) only catches reminders whose schedule was lost
+
+# reminder texts: (title, body) for a transaction
+def reminder_day_text(trans):
+    return (
+        f"Reminder: please return {trans.items_for_loan_id.label} tomorrow",
+        f"Hi {trans.borrower_member_id.nickname}, \n\n"
+        f"just a friendly reminder about the {trans.items_for_loan_id.label} you borrowed on {trans.borrowed_on}. "
+        "If possible, could you please bring it back tomorrow? Thanks a bunch! \n\n"
+        f"Your neighbour {trans.lender_member_id.nickname} from {trans.lender_member_id.flat_no}"
+    )
+
+def reminder_hours_text(trans):
+    return (
+        f"Reminder: please return {trans.items_for_loan_id.label} today",
+        f"Hi {trans.borrower_member_id.nickname}, \n\n"
+        f"just a friendly reminder about the {trans.items_for_loan_id.label} you borrowed on {trans.borrowed_on}. "
+        f"If possible, could you please bring it back today, the borrowing time ends on {trans.borrowed_until}? Thanks a bunch! \n\n"
+        f"Your neighbour {trans.lender_member_id.nickname} from {trans.lender_member_id.flat_no}"
+    )
+
+def overdue_text(trans):
+    return (
+        f"Reminder: please return {trans.items_for_loan_id.label} as soon as possible",
+        f"Hi {trans.borrower_member_id.nickname}, just a friendly reminder that the loan period for {trans.items_for_loan_id.label} "
+        f"has ended on {trans.borrowed_until}. Could you please return it as soon as possible? Thanks!\n\n"
+        f"Your neighbour {trans.lender_member_id.nickname} from {trans.lender_member_id.flat_no}"
+    )
+
+def overdue_escalation_text(trans):
+    return (
+        f"Urgently: please return {trans.items_for_loan_id.label} overdue",
+        f"Hi {trans.borrower_member_id.nickname}, the loan period for the {trans.items_for_loan_id.label} is over. "
+        f"Return {trans.items_for_loan_id.label} immediately.\n\n"
+        f"Your neighbour {trans.lender_member_id.nickname} from {trans.lender_member_id.flat_no}"
+    )
+
+# reminder windows: (reminder states, next state, due after / due until relative to now, text)
+# a transaction can be in several windows at once (e.g. standard and due in 1 hour), the rules are
+# checked in this order and the first one that matches wins, so a transaction gets at most one reminder per run
+REMINDER_RULES = (
+    # Case 1: Due in less than 1 day and reminder is STANDARD
+    ((ReminderType.STANDARD,), ReminderType.REMINDER_DAY, timedelta(0), timedelta(days=1), reminder_day_text),
+    # Case 2: Due in less than 2 hours and reminder is STANDARD or REMINDER_DAY
+    ((ReminderType.STANDARD, ReminderType.REMINDER_DAY), ReminderType.REMINDER_HOURS,
+     timedelta(0), timedelta(hours=2), reminder_hours_text),
+    # Case 3: Overdue for at least 3 hours and reminder is STANDARD, REMINDER_DAY or REMINDER_HOURS
+    ((ReminderType.STANDARD, ReminderType.REMINDER_DAY, ReminderType.REMINDER_HOURS), ReminderType.OVERDUE,
+     None, -timedelta(hours=3), overdue_text),
+    # Case 4: Overdue for at least 1 day and reminder is STANDARD, REMINDER_DAY, REMINDER_HOURS or OVERDUE
+    ((ReminderType.STANDARD, ReminderType.REMINDER_DAY, ReminderType.REMINDER_HOURS, ReminderType.OVERDUE),
+     ReminderType.OVERDUE_ESC, None, -timedelta(days=1), overdue_escalation_text),
+)
+
+
+REMINDER_TASK = 'neighborow.tasks.send_transaction_reminder'
+
+
+# send the reminders of the open transactions that entered a reminder window, all or only the given ones
+# each window is one indexed query, messages and reminder states are written in bulk
+# returns the transactions that got a reminder
+def send_due_reminders(admin_user, transaction_ids=None):
+    now = timezone.now()
+    reminded = []
+    for reminders, next_reminder, after, until, reminder_text in REMINDER_RULES:
+        with transaction.atomic():
+            due = Transaction.custom_objects.due_for_reminder(
+                reminders, None if after is None else now + after, now + until
+            )
+            if transaction_ids is not None:
+                due = due.filter(id__in=transaction_ids)
+            if reminded:
+                # reminded by an earlier rule of this run, its next reminder follows in a later run
+                due = due.exclude(id__in=[trans.id for trans in reminded])
+            if connection.features.has_select_for_update_skip_locked:
+                # PostgreSQL: transactions locked by an overlapping run are left to that run
+                due = due.select_for_update(skip_locked=True, of=('self',))
+            due = list(due)
+            if not due:
+                continue
+
+            messages = []
+            for trans, message_code in zip(due, generate_unique_message_codes(len(due))):
+                title, body = reminder_text(trans)
+                messages.append(Messages(
+                    sender_member_id=trans.lender_member_id,
+                    receiver_member_id=trans.borrower_member_id,
+                    title=title,
+                    body=body,
+                    message_code=message_code,
+                    inbox=False,
+                    outbox=True,
+                    internal=True,
+                    is_sent_email=False,
+                    is_sent_sms=False,
+                    is_sent_whatsApp=False,
+                    message_type=MessageType.REMINDER,
+                    created_by=admin_user,
+                ))
+                trans.reminder = next_reminder
+                trans.modified = now
+            Messages.objects.bulk_create(messages)
+            Transaction.objects.bulk_update(due, ['reminder', 'modified'])
+            wake_dispatcher()
+            reminded += due
+    return reminded
+
+# time the next reminder of a transaction is due, None if it gets no further reminder
+def get_next_reminder_time(trans, now=None):
+    if trans.return_date is not None or trans.borrowed_until is None:
+        return None
+    now = now or timezone.now()
+    times = []
+    for reminders, next_reminder, after, until, reminder_text in REMINDER_RULES:
+        if trans.reminder not in reminders:
+            continue
+        # the window is open from borrowed_until - until to borrowed_until - after
+        opens = max(trans.borrowed_until - until, now)
+        if after is not None and trans.borrowed_until - after <= opens:
+            continue
+        times.append(opens)
+    return min(times, default=None)
+
+def get_reminder_schedule_name(transaction_id):
+    return f"transaction_reminder_{transaction_id}"
+
+# arm the one-shot schedules of the next reminders of some transactions (one query per step, not per transaction)
+# schedules of transactions without further reminders (returned, escalated) are removed
+# a schedule row stays with repeats 0 after its run and is armed again here
+def schedule_transaction_reminders(transactions):
+    from django_q.models import Schedule
+
+    now = timezone.now()
+    next_runs = {get_reminder_schedule_name(trans.pk): (trans.pk, get_next_reminder_time(trans, now)) for trans in transactions}
+    cancelled = [name for name, (transaction_id, next_run) in next_runs.items() if next_run is None]
+    if cancelled:
+        Schedule.objects.filter(name__in=cancelled).delete()
+    armed = {name: value for name, value in next_runs.items() if value[1] is not None}
+    if not armed:
+        return
+
+    existing = {schedule.name: schedule for schedule in Schedule.objects.filter(name__in=armed)}
+    updated = []
+    created = []
+    for name, (transaction_id, next_run) in armed.items():
+        schedule = existing.get(name)
+        if schedule is None:
+            created.append(Schedule(name=name, func=REMINDER_TASK, args=f"({transaction_id},)",
+                                    schedule_type=Schedule.ONCE, repeats=1, next_run=next_run))
+        else:
+            schedule.next_run = next_run
+            schedule.repeats = 1
+            updated.append(schedule)
+    Schedule.objects.bulk_create(created)
+    Schedule.objects.bulk_update(updated, ['next_run', 'repeats'])
+
+# arm the schedules of open transactions that have none, run by the post_migrate setup (deploy) for
+# loans opened before the one-shot schedules existed; schedules left at repeats 0 count as missing
+# (a loan whose on_commit callback was lost gets its next reminder from the sweep, which arms it again)
+# one anti-join query, returns the number of armed transactions
+def schedule_missing_transaction_reminders(batch_size=500):
+    from django_q.models import Schedule
+
+    armed = Schedule.objects.filter(
+        name=Concat(Value(get_reminder_schedule_name('')), Cast(OuterRef('id'), CharField())),
+        repeats__gt=0
+    )
+    missing = list(Transaction.objects.filter(
+        return_date__isnull=True, borrowed_until__isnull=False
+    ).exclude(reminder=ReminderType.OVERDUE_ESC).filter(~Exists(armed)).order_by('id').values_list('id', flat=True))
+    for start in range(0, len(missing), batch_size):
+        schedule_transaction_reminders(Transaction.objects.filter(id__in=missing[start:start + batch_size]))
+    return len(missing)
@@ -0,0 +1,75 @@
+from collections import namedtuple
+from django.db import connection
+
+# full-text search of the items for loan, the backend follows the active database:
+# PostgreSQL: generated tsvector column (GIN index) and a pg_trgm index for substrings and typos
+# SQLite: FTS5 shadow table with the trigram tokenizer (substring matches)
+# the index structures are created by migration 0012_items_for_loan_search
+
+# FTS5 shadow table of neighborow_items_for_loan (SQLite)
+ITEM_SEARCH_TABLE = "neighborow_items_for_loan_fts"
+# shortest search string the trigram tokenizer can match, shorter strings are searched with LIKE
+TRIGRAM_MIN_LENGTH = 3
+
+# sql fragments of a search: join, filter and relevance (higher is better), each with its parameters
+SearchClauses = namedtuple('SearchClauses', ['join', 'join_params', 'where', 'where_params', 'rank', 'rank_params'])
+
+
+# PostgreSQL: tsvector match or trigram substring / similarity match, ranked by both
+class PostgresItemSearch:
+    DOCUMENT = "lower(i.label || ' ' || i.description)"
+
+    def clauses(self, search_string):
+        query = search_string.lower()
+        return SearchClauses(
+            join="",
+            join_params=[],
+            where=(f"(i.search_vector @@ websearch_to_tsquery('simple', %s) OR {self.DOCUMENT} LIKE %s "
+                   f"OR %s <%% {self.DOCUMENT})"),
+            where_params=[search_string, f"%{query}%", query],
+            # real, cast to float8: the page cursor carries the rank as a double, compared against
+            # the real rank a row tied at the page boundary would be skipped or read twice
+            rank=(f"CAST(ts_rank(i.search_vector, websearch_to_tsquery('simple', %s)) "
+                  f"+ word_similarity(%s, {self.DOCUMENT}) AS float8)"),
+            rank_params=[search_string, query],
+        )
+
+
+# SQLite: phrase match on the trigram FTS5 table (= case-insensitive substring), ranked by bm25
+# with the label weighted above the description
+class SqliteItemSearch:
+    def clauses(self, search_string):
+        if len(search_string) < TRIGRAM_MIN_LENGTH:
+            return LikeItemSearch().clauses(search_string)
+        phrase = '"' + search_string.replace('"', '""') + '"'
+        return SearchClauses(
+            join=f"INNER JOIN {ITEM_SEARCH_TABLE} ON {ITEM_SEARCH_TABLE}.rowid = i.id",
+            join_params=[],
+            where=f"{ITEM_SEARCH_TABLE} MATCH %s",
+            where_params=[phrase],
+            rank=f"(-bm25({ITEM_SEARCH_TABLE}, 2.0, 1.0))",
+            rank_params=[],
+        )
+
+
+# other databases: substring scan without ranking
+class LikeItemSearch:
+    def clauses(self, search_string):
+        search_pattern = f"%{search_string}%"
+        return SearchClauses(
+            join="",
+            join_params=[],
+            where="(LOWER(i.label) LIKE LOWER(%s) OR LOWER(i.description) LIKE LOWER(%s))",
+            where_params=[search_pattern, search_pattern],
+            rank="0.0",
+            rank_params=[],
+        )
+
+
+# search backend of the active database
+def get_item_search():
+    if connection.vendor == 'postgresql':
+        return PostgresItemSearch()
+    if connection.vendor == 'sqlite':
+        return SqliteItemSearch()
+    return LikeItemSearch()
@@ -1,12 +1,17 @@
 import logging
-from django.db.models.signals import post_save, pre_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.utils import timezone
 from .models import (Borrowing_Request_Recipients, Borrowing_Request, 
                      Messages, Member, Communication, Channels, 
-                     Invitation, Items_For_Loan, Transaction)
+                     Invitation, Items_For_Loan, Items_For_Loan_Image, Transaction)
 from django.contrib.auth.models import User
 from .utils import generate_unique_message_code
+from .fanout import get_borrowing_request_content
+from .polling import wake_dispatcher
+from .reminders import schedule_transaction_reminders
+from .catalog import invalidate_catalog, invalidate_member_catalog, invalidate_item_catalog
 
 logger = logging.getLogger(__name__)
 
@@ -33,20 +38,16 @@ def create_messages(sender, instance, created, raw, **kwargs):
         message_code = generate_unique_message_code()
 
 
-        # Append borrowing period information if set
-        new_body = borrowing_request_instance.body
-        if borrowing_request_instance.required_from or borrowing_request_instance.required_until:
-            new_body += (
-                f"\nRequired borrowing period from {borrowing_request_instance.required_from} "
-                f"to {borrowing_request_instance.required_until}"
-            )
+        # Title and body are stored once per borrowing request and shared by all recipients
+        content = get_borrowing_request_content(borrowing_request_instance, user_instance)
 
         # Create the new Message record
         Messages.objects.create(
             sender_member_id=sender_member_instance,
             receiver_member_id=receiver_member_instance,
-            title=borrowing_request_instance.title,
-            body=new_body,
+            title='',
+            body='',
+            content_id=content,
             message_code=message_code,
             outbox=True,
             is_sent_email=False,
@@ -60,8 +61,9 @@ def create_messages(sender, instance, created, raw, **kwargs):
         Messages.objects.create(
             sender_member_id=sender_member_instance,
             receiver_member_id=receiver_member_instance,
-            title=borrowing_request_instance.title,
-            body=new_body,
+            title='',
+            body='',
+            content_id=content,
             message_code=message_code,
             outbox=False,
             inbox=True,
@@ -74,6 +76,15 @@ def create_messages(sender, instance, created, raw, **kwargs):
             created_by=user_instance
         )
 
+# wake the backed off dispatcher when a message waiting for delivery is written
+# (bulk inserts of the fan-out wake it per chunk)
+@receiver(post_save, sender=Messages)
+def wake_dispatcher_for_outbox(sender, instance, created, raw, **kwargs):
+    if raw or not created or not instance.outbox or instance.inbox:
+        return
+    if not (instance.is_sent_email and instance.is_sent_sms and instance.is_sent_whatsApp):
+        wake_dispatcher()
+
 # When a new Member instance is created, set default communication channel
 @receiver(post_save, sender=Member)
 def create_default_communication(sender, instance, created, raw, **kwargs):
@@ -147,6 +158,15 @@ def update_available_from(sender, instance, **kwargs):
             instance.available_from = timezone.now()
 
 
+# keep the primary image columns of the item in step with its images (upload, caption change, delete)
+@receiver(post_save, sender=Items_For_Loan_Image)
+@receiver(post_delete, sender=Items_For_Loan_Image)
+def update_primary_image(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    Items_For_Loan.custom_objects.refresh_primary_image(instance.items_for_loan_id_id)
+
+
 # When a transaction record chnges set new borrowed_on date based on future transactiosn
 @receiver(post_save, sender=Transaction)
 def update_item_availability(sender, instance, **kwargs):
@@ -171,4 +191,43 @@ def update_item_availability(sender, instance, **kwargs):
     # Updatethe  Items: available_from and currently_borrowed based on compariosn to now
     item.available_from = min_date
     item.currently_borrowed = min_date > now_time
-    item.save(update_fields=['available_from', 'currently_borrowed'])
\ No newline at end of file
+    item.save(update_fields=['available_from', 'currently_borrowed'])
+
+# arm the reminder schedule of a new or changed transaction (due date, return) once it is committed
+@receiver(post_save, sender=Transaction)
+def schedule_reminders(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    transaction.on_commit(lambda: schedule_transaction_reminders([instance]))
+
+
+# invalidate the cached item list of the building (see neighborow.catalog) when one of its items,
+# item images, loans or members changes, after update_primary_image has written the image columns
+@receiver(post_save, sender=Items_For_Loan)
+@receiver(post_delete, sender=Items_For_Loan)
+def invalidate_catalog_for_item(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    invalidate_member_catalog(instance.member_id_id)
+
+@receiver(post_save, sender=Items_For_Loan_Image)
+@receiver(post_delete, sender=Items_For_Loan_Image)
+def invalidate_catalog_for_image(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    invalidate_item_catalog(instance.items_for_loan_id_id)
+
+# loans change currently_borrowed and available_from of the item
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+def invalidate_catalog_for_transaction(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    invalidate_member_catalog(instance.lender_member_id_id)
+
+# nickname and flat number of the lenders are shown in the list
+@receiver(post_save, sender=Member)
+def invalidate_catalog_for_member(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    invalidate_catalog(instance.building_id_id)
@@ -2,6 +2,7 @@ import pytest
 from django.db.models.signals import post_save
 from neighborow.models import Borrowing_Request_Recipients
 from neighborow.signals import create_messages
+from neighborow.catalog import get_catalog_cache
 
 
 @pytest.fixture(autouse=True)
@@ -16,3 +17,9 @@ def disable_signals(request):
 
         post_save.connect(create_messages, sender=Borrowing_Request_Recipients)
 
+
+# cached item lists of one test must not leak into the next (ids are reused after the rollback)
+@pytest.fixture(autouse=True)
+def clear_catalog_cache():
+    get_catalog_cache().clear()
+    yield
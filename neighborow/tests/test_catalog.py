@@ -0,0 +1,102 @@
+import pytest
+from io import StringIO
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from neighborow.catalog import get_catalog_page, get_catalog_stats
+from neighborow.models import (
+    Building, Access_Code, Member, Items_For_Loan, Items_For_Loan_Image, Transaction
+)
+
+#==================================================================================
+# SIMPLE FIXTURES FOR ALL CATALOG TESTS
+#==================================================================================
+# two members of one building and one member of another building
+@pytest.fixture
+def members(db):
+    buildings = [Building.objects.create(name=f"Building {i}") for i in range(2)]
+    members = []
+    for i, building in enumerate([buildings[0], buildings[0], buildings[1]]):
+        user = User.objects.create_user(username=f"user{i}", password="neighborow")
+        access_code = Access_Code.objects.create(building_id=building, flat_no=f"Flat {i}", code=f"CODE12345678900{i}", created_by=user)
+        members.append(Member.objects.create(user_id=user, building_id=building, access_code_id=access_code,
+                                             nickname=f"nickname {i}", flat_no=f"Flat {i}", authorized=True))
+    return members
+
+# helper: item ids of a catalog page and the number of queries it took
+def read_page(member, cursor=None, search_string=None):
+    with CaptureQueriesContext(connection) as queries:
+        items, has_next = get_catalog_page(member, 10, cursor, search_string)
+    return [item['id'] for item in items], len(queries)
+
+
+#==================================================================================
+# TEST get_catalog_page
+#==================================================================================
+# Test that a page is read from the database once and then from the cache, shared by the members of the building
+@pytest.mark.django_db
+def test_catalog_page_is_cached_per_building(members):
+    drill = Items_For_Loan.objects.create(member_id=members[0], label="Drill", description="Cordless drill")
+    Items_For_Loan.objects.create(member_id=members[2], label="Ladder", description="Other building")
+
+    assert read_page(members[0]) == ([drill.id], 1)
+    assert read_page(members[0]) == ([drill.id], 0)
+    items, has_next = get_catalog_page(members[1], 10)
+    assert [(item['id'], item['user_member_id'], item['user_member_nickname']) for item in items] == [
+        (drill.id, members[1].id, "nickname 1")]
+    assert read_page(members[0], search_string="drill") == ([drill.id], 1)
+    assert read_page(members[0], search_string="drill") == ([drill.id], 0)
+    assert get_catalog_stats()['hits'] == 3 and get_catalog_stats()['misses'] == 2
+
+# Test that item, image, loan and member changes invalidate only the pages of their building
+@pytest.mark.django_db
+def test_catalog_page_invalidation(members):
+    drill = Items_For_Loan.objects.create(member_id=members[0], label="Drill", description="Cordless drill")
+    ladder = Items_For_Loan.objects.create(member_id=members[2], label="Ladder", description="Other building")
+    read_page(members[0])
+    read_page(members[2])
+
+    saw = Items_For_Loan.objects.create(member_id=members[1], label="Saw", description="Hand saw")
+    assert read_page(members[0]) == ([saw.id, drill.id], 1)
+    assert read_page(members[2]) == ([ladder.id], 0)
+
+    image = Items_For_Loan_Image.objects.create(
+        items_for_loan_id=drill, image=SimpleUploadedFile("drill.jpg", b"drill", content_type="image/jpeg"), caption="Drill")
+    items, has_next = get_catalog_page(members[0], 10)
+    assert items[1]['image_id'] == image.id
+
+    image.delete()
+    items, has_next = get_catalog_page(members[0], 10)
+    assert items[1]['image_id'] is None
+
+    now = timezone.now()
+    Transaction.objects.create(items_for_loan_id=saw, lender_member_id=members[1], borrower_member_id=members[0],
+                               borrowed_on=now + timezone.timedelta(days=1), borrowed_until=now + timezone.timedelta(days=2))
+    items, has_next = get_catalog_page(members[0], 10)
+    assert items[0]['currently_borrowed']
+
+    members[0].nickname = "new nickname"
+    members[0].save()
+    items, has_next = get_catalog_page(members[1], 10)
+    assert items[1]['lender_member_nickname'] == "new nickname"
+
+    drill.delete()
+    assert read_page(members[0]) == ([saw.id], 1)
+    assert read_page(members[2]) == ([ladder.id], 0)
+
+
+#==================================================================================
+# TEST command catalog_stats
+#==================================================================================
+# Test that the command shows the counters and resets them
+@pytest.mark.django_db
+def test_catalog_stats_command(members):
+    get_catalog_page(members[0], 10)
+    get_catalog_page(members[0], 10)
+    out = StringIO()
+    call_command('catalog_stats', '--reset', stdout=out)
+    assert "hits: 1, misses: 1, hit rate: 50.0%" in out.getvalue()
+    assert get_catalog_stats() == {'hits': 0, 'misses': 0, 'hit_rate': None}
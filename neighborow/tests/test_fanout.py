@@ -0,0 +1,158 @@
+import pytest
+from django.contrib.auth.models import User
+from neighborow.models import (
+    Building, Access_Code, Member, Borrowing_Request, Borrowing_Request_Recipients,
+    Messages, Message_Content, MessageType, Fan_Out_Job, FanOutStatus
+)
+from neighborow import fanout
+from neighborow.fanout import fan_out_borrowing_request, fan_out_free_message, run_fan_out_job
+
+#==================================================================================
+# SIMPLE FIXTURES FOR ALL FAN-OUT TESTS
+#==================================================================================
+@pytest.fixture
+def user(db):
+    return User.objects.create_user(username="user", password="neighborow")
+
+@pytest.fixture
+def building(db):
+    return Building.objects.create(name="Test Building", address_line1="Test Street 123")
+
+@pytest.fixture
+def members(db, user, building):
+    members = []
+    for i in range(4):
+        member_user = user if i == 0 else User.objects.create_user(username=f"user{i}", password="neighborow")
+        access_code = Access_Code.objects.create(building_id=building, flat_no=f"Flat {i}", code=f"CODE12345678900{i}", created_by=member_user)
+        members.append(Member.objects.create(user_id=member_user, building_id=building, access_code_id=access_code,
+                                             nickname=f"nickname {i}", flat_no=f"Flat {i}", authorized=True))
+    return members
+
+@pytest.fixture
+def borrowing_request(db, members, user):
+    return Borrowing_Request.objects.create(member_id=members[0], title="Borrowing Request title",
+                                            body="Please lend me a drill.", created_by=user)
+
+# helper: compare message rows without ids, codes and timestamps
+def message_rows(messages):
+    fields = ['sender_member_id', 'receiver_member_id', 'title', 'body', 'content_id', 'inbox', 'outbox', 'internal',
+              'is_sent_email', 'is_sent_sms', 'is_sent_whatsApp', 'message_type', 'created_by']
+    return sorted(tuple(getattr(message, f"{field}_id", None) if field in ('sender_member_id', 'receiver_member_id', 'content_id', 'created_by')
+                        else getattr(message, field) for field in fields)
+                  for message in messages)
+
+
+#==================================================================================
+# TEST fan_out_borrowing_request
+#==================================================================================
+# Test that the bulk fan-out writes the same rows as the create_messages signal
+@pytest.mark.django_db
+@pytest.mark.enable_signals
+def test_fan_out_borrowing_request_same_rows_as_signal(members, borrowing_request, user):
+    # signal path: one recipient saved at a time
+    signal_recipient = Borrowing_Request_Recipients.objects.create(member_id=members[1], borrowing_request=borrowing_request, created_by=user)
+    signal_messages = Messages.objects.filter(message_type=MessageType.BORREQ.value, message_type_id=signal_recipient.pk)
+
+    recipients = fan_out_borrowing_request(borrowing_request, [members[2].id], user)
+    fanout_messages = Messages.objects.filter(message_type=MessageType.BORREQ.value, message_type_id=recipients[0].pk)
+
+    assert recipients[0].created_by == user
+    rows = message_rows(fanout_messages)
+    # only the receiver differs
+    assert [row[:1] + row[2:] for row in rows] == [row[:1] + row[2:] for row in message_rows(signal_messages)]
+    assert {row[1] for row in rows} == {members[2].id}
+    codes = set(fanout_messages.values_list('message_code', flat=True))
+    assert len(codes) == 1 and len(codes.pop()) == 16
+
+# Test that a building wide borrowing request needs a constant number of queries
+@pytest.mark.django_db
+def test_fan_out_borrowing_request_constant_queries(members, borrowing_request, user, django_assert_max_num_queries):
+    with django_assert_max_num_queries(6):
+        recipients = fan_out_borrowing_request(borrowing_request, [member.id for member in members], user)
+    assert len(recipients) == 4
+    assert Messages.objects.filter(message_type=MessageType.BORREQ.value).count() == 8
+    assert Messages.objects.filter(content_id=borrowing_request.content_id).count() == 8
+    # every recipient has its own message code
+    assert Messages.objects.values('message_code').distinct().count() == 4
+
+
+#==================================================================================
+# TEST fan_out_free_message
+#==================================================================================
+# Test that a free message creates an outbox and an inbox message per recipient sharing one content
+@pytest.mark.django_db
+def test_fan_out_free_message(members, user, django_assert_max_num_queries):
+    content = Message_Content.objects.create(title="Subject", body="Body", created_by=user)
+    with django_assert_max_num_queries(3):
+        messages = fan_out_free_message(members[0], [member.id for member in members[1:]], content, user)
+    assert len(messages) == 6
+    outbox = Messages.objects.filter(outbox=True)
+    inbox = Messages.objects.filter(inbox=True)
+    assert outbox.count() == 3 and inbox.count() == 3
+    assert not outbox.filter(is_sent_email=True).exists()
+    assert not inbox.filter(is_sent_email=False).exists()
+    assert not Messages.objects.exclude(message_type=MessageType.FREE_MESSAGE.value).exists()
+    assert not Messages.objects.filter(internal=True).exists()
+    assert {message.text for message in Messages.objects.all()} == {"Body"}
+
+
+#==================================================================================
+# TEST run_fan_out_job
+#==================================================================================
+# Test that a job for all neighbours writes the messages in chunks and reports its progress
+@pytest.mark.django_db
+def test_run_fan_out_job_all_recipients_in_chunks(members, borrowing_request, user, monkeypatch):
+    monkeypatch.setattr(fanout, "FANOUT_CHUNK_SIZE", 3)
+    job = Fan_Out_Job.objects.create(message_type=MessageType.BORREQ, sender_member_id=members[0],
+                                     borrowing_request=borrowing_request, all_recipients=True, created_by=user)
+    job = run_fan_out_job(job.id)
+    assert (job.status, job.total, job.processed) == (FanOutStatus.DONE, 4, 4)
+    assert Borrowing_Request_Recipients.objects.filter(borrowing_request=borrowing_request).count() == 4
+    assert Messages.objects.filter(message_type=MessageType.BORREQ.value).count() == 8
+
+# Test that running a job again after an interruption only writes the missing recipients
+@pytest.mark.django_db
+def test_run_fan_out_job_idempotent(members, user):
+    content = Message_Content.objects.create(title="Subject", body="Body", created_by=user)
+    recipient_ids = [members[1].id, members[2].id, members[3].id, members[1].id]
+    job = Fan_Out_Job.objects.create(message_type=MessageType.FREE_MESSAGE, sender_member_id=members[0],
+                                     content_id=content, recipient_ids=recipient_ids, created_by=user)
+    # an earlier run stopped after the first recipient
+    fan_out_free_message(members[0], [members[1].id], content, user)
+    Fan_Out_Job.objects.filter(pk=job.pk).update(status=FanOutStatus.RUNNING, total=3, processed=1)
+
+    job = run_fan_out_job(job.id)
+    assert (job.status, job.total, job.processed) == (FanOutStatus.DONE, 3, 3)
+    assert Messages.objects.filter(content_id=content, outbox=True).count() == 3
+    # a finished job is not written twice
+    run_fan_out_job(job.id)
+    assert Messages.objects.filter(content_id=content).count() == 6
+
+# Test that a failing job is marked as failed with the error
+@pytest.mark.django_db
+def test_run_fan_out_job_failed(members, user, monkeypatch):
+    content = Message_Content.objects.create(title="Subject", body="Body", created_by=user)
+    job = Fan_Out_Job.objects.create(message_type=MessageType.FREE_MESSAGE, sender_member_id=members[0],
+                                     content_id=content, recipient_ids=[members[1].id], created_by=user)
+    def broken_fan_out(*args):
+        raise RuntimeError("database gone")
+    monkeypatch.setattr(fanout, "fan_out_free_message", broken_fan_out)
+    with pytest.raises(RuntimeError):
+        run_fan_out_job(job.id)
+    job.refresh_from_db()
+    assert (job.status, job.last_error) == (FanOutStatus.FAILED, "database gone")
+    assert not Messages.objects.exists()
+
+# Test that chosen ids of unknown members and members of other buildings are skipped, the others get their messages
+@pytest.mark.django_db
+def test_run_fan_out_job_skips_unknown_recipients(members, borrowing_request, user):
+    other_building = Building.objects.create(name="Other Building", address_line1="Other Street 1")
+    access_code = Access_Code.objects.create(building_id=other_building, flat_no="Flat 9", code="CODE123456789009", created_by=user)
+    stranger = Member.objects.create(user_id=User.objects.create_user(username="stranger", password="neighborow"),
+                                     building_id=other_building, access_code_id=access_code, nickname="stranger", flat_no="Flat 9")
+    job = Fan_Out_Job.objects.create(message_type=MessageType.BORREQ, sender_member_id=members[0], borrowing_request=borrowing_request,
+                                     recipient_ids=[members[2].id, 999999, stranger.id, members[1].id], created_by=user)
+    job = run_fan_out_job(job.id)
+    assert (job.status, job.total, job.processed) == (FanOutStatus.DONE, 2, 2)
+    assert sorted(Borrowing_Request_Recipients.objects.values_list('member_id', flat=True)) == [members[1].id, members[2].id]
+    assert set(Messages.objects.values_list('receiver_member_id', flat=True)) == {members[1].id, members[2].id}
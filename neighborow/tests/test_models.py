@@ -1,7 +1,8 @@
 import pytest 
 import datetime
 import re 
-from django.db import IntegrityError 
+from django.db import IntegrityError, connection
+from django.db.models import Q
 from django.core.exceptions import ValidationError 
 from django.core.files.uploadedfile import SimpleUploadedFile 
 from django.contrib.auth.models import User 
@@ -9,8 +10,9 @@ from neighborow.models import ( Building, AppSettings, Access_Code, Member,
         Invitation, Messages, Communication, 
         Borrowing_Request, Borrowing_Request_Recipients, 
         Items_For_Loan, Items_For_Loan_Image, Condition_Log, 
-        Condition_Image, Transaction, ApplicationSettings, 
+        Condition_Image, Transaction, Delivery_Attempt, Message_Content, ApplicationSettings, 
         MemberType, Relationship, MessageType, Channels, ReminderType )
+from neighborow.utils import decode_page_cursor, encode_page_cursor
 
 #==================================================================================
 # SIMPLE FIXTURES FOR ALL MODELS
@@ -842,6 +844,102 @@ class TestMessages:
         with pytest.raises(ValidationError):
             m.full_clean()
 
+#==================================================================================
+# TESTS MODEL Message_Content
+#==================================================================================
+class TestMessageContent:
+    # Test that messages with shared content read title and body from the content
+    @pytest.mark.django_db
+    def test_message_content_shared_by_messages(self, message, user):
+        content = Message_Content.objects.create(title="Shared Title", body="Shared body", created_by=user)
+        shared = Messages.objects.create(sender_member_id=message.sender_member_id, receiver_member_id=message.receiver_member_id,
+                                         title="", body="", content_id=content, message_code="CODE123456789124", created_by=user)
+        assert shared.subject == "Shared Title"
+        assert shared.text == "Shared body"
+        assert list(content.messages.all()) == [shared]
+        assert str(content) == str(content.id)
+
+    # Test that messages without shared content keep their own title and body
+    @pytest.mark.django_db
+    def test_message_without_content(self, message):
+        assert message.subject == "Message Title"
+        assert message.text == "This is a test message body"
+
+    # Test that deleting the content deletes the messages referencing it
+    @pytest.mark.django_db
+    def test_message_content_delete_cascade(self, message, user):
+        content = Message_Content.objects.create(title="Shared Title", body="Shared body", created_by=user)
+        Messages.objects.filter(id=message.id).update(content_id=content)
+        content.delete()
+        assert not Messages.objects.filter(id=message.id).exists()
+
+#==================================================================================
+# TESTS Messages indexes (query plans of dispatcher and inbox/outbox widgets)
+#==================================================================================
+# helper: return the query plan, on PostgreSQL sequential scans are disabled because
+# the planner prefers them for the few rows of the test database
+def explain(queryset):
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+    return queryset.explain()
+
+class TestMessagesIndexes:
+    # Test that the dispatcher query on pending outbox rows uses the partial index
+    @pytest.mark.django_db
+    def test_pending_delivery_uses_index(self, message):
+        plan = explain(Messages.custom_objects.pending_delivery().filter(id__gt=0).order_by('id'))
+        assert "messages_pending_delivery_idx" in plan
+
+    # Test that the inbox widget query uses the receiver index and needs no sort
+    @pytest.mark.django_db
+    def test_inbox_query_uses_index(self, message):
+        plan = explain(Messages.objects.filter(
+            Q(receiver_member_id=message.receiver_member_id),
+            (Q(inbox=True) | Q(internal=True))
+        ).order_by('-created'))
+        assert "messages_inbox_idx" in plan
+        assert "TEMP B-TREE" not in plan and "Sort" not in plan
+
+    # Test that the outbox widget query uses the sender index and needs no sort
+    @pytest.mark.django_db
+    def test_outbox_query_uses_index(self, message):
+        plan = explain(Messages.objects.filter(
+            Q(sender_member_id=message.sender_member_id),
+            Q(outbox=True)
+        ).order_by('-created'))
+        assert "messages_outbox_idx" in plan
+        assert "TEMP B-TREE" not in plan and "Sort" not in plan
+
+#==================================================================================
+# TESTS MODEL Delivery_Attempt
+#==================================================================================
+class TestDeliveryAttempt:
+    # Test that a new delivery attempt starts without attempts and not as dead letter
+    @pytest.mark.django_db
+    def test_delivery_attempt_defaults(self, message):
+        attempt = Delivery_Attempt.objects.create(message_id=message)
+        assert attempt.channel == Channels.EMAIL
+        assert attempt.attempts == 0
+        assert attempt.last_error == ''
+        assert attempt.is_dead_letter is False
+        assert str(attempt) == str(attempt.id)
+
+    # Test that there is only one delivery attempt record per message and channel
+    @pytest.mark.django_db
+    def test_delivery_attempt_unique_message_channel(self, message):
+        Delivery_Attempt.objects.create(message_id=message, channel=Channels.SMS)
+        with pytest.raises(IntegrityError):
+            Delivery_Attempt.objects.create(message_id=message, channel=Channels.SMS)
+
+    # Test that dead letter messages are not pending for delivery anymore
+    @pytest.mark.django_db
+    def test_dead_letter_message_not_pending(self, message):
+        Messages.objects.filter(id=message.id).update(outbox=True)
+        assert Messages.custom_objects.pending_delivery().filter(id=message.id).exists()
+        Messages.objects.filter(id=message.id).update(is_dead_letter=True)
+        assert not Messages.custom_objects.pending_delivery().filter(id=message.id).exists()
+
 #==================================================================================
 # TESTS MODEL Communication
 #==================================================================================
@@ -1338,6 +1436,76 @@ class TestItemsForLoan:
         results = Items_For_Loan.custom_objects.get_filtered_items_for_loan(member.id, "Loan")
         assert isinstance(results, list)
 
+    # Test that the keyset pages of get_items_for_loan_page follow each other without gaps or repeats,
+    # also for items modified at the same time
+    @pytest.mark.django_db
+    def test_items_for_loan_custom_manager_get_items_for_loan_page(self, member, user, items_for_loan):
+        for i in range(6):
+            Items_For_Loan.objects.create(member_id=member, label=f"Loan item {i}", description="Paged", created_by=user)
+        Items_For_Loan.objects.filter(label__in=["Loan item 2", "Loan item 3", "Loan item 4"]).update(
+            modified=datetime.datetime(2026, 1, 1, 12, 0))
+        pages = []
+        cursor = None
+        while True:
+            items, has_next = Items_For_Loan.custom_objects.get_items_for_loan_page(member.id, 3, cursor)
+            pages.append([item['id'] for item in items])
+            if not has_next:
+                break
+            cursor = (items[-1]['modified'], items[-1]['id'])
+        assert [len(page) for page in pages] == [3, 3, 1]
+        assert sum(pages, []) == [item['id'] for item in Items_For_Loan.custom_objects.get_items_for_loan(member.id)]
+
+        items, has_next = Items_For_Loan.custom_objects.get_items_for_loan_page(member.id, 3, search_string="item 5")
+        assert [item['label'] for item in items] == ["Loan item 5"] and not has_next
+
+    # Test that the full-text search finds substrings, ranks label matches above description matches,
+    # follows updates of the items and pages by (rank, modified, id)
+    @pytest.mark.django_db
+    def test_items_for_loan_custom_manager_search(self, member, user, items_for_loan):
+        drill = Items_For_Loan.objects.create(member_id=member, label="Cordless Drill", description="18V", created_by=user)
+        bits = Items_For_Loan.objects.create(member_id=member, label="Bit set", description="For any drill", created_by=user)
+        ladder = Items_For_Loan.objects.create(member_id=member, label="Ladder", description="3 m", created_by=user)
+
+        results = Items_For_Loan.custom_objects.get_filtered_items_for_loan(member.id, "DRILL")
+        assert [item['id'] for item in results] == [drill.id, bits.id]
+        assert results[0]['search_rank'] > results[1]['search_rank']
+
+        ladder.description = "Reaches any drill hole"
+        ladder.save()
+        drill.delete()
+        results = Items_For_Loan.custom_objects.get_filtered_items_for_loan(member.id, "drill")
+        assert {item['id'] for item in results} == {bits.id, ladder.id}
+
+        pages = []
+        cursor = None
+        while True:
+            items, has_next = Items_For_Loan.custom_objects.get_items_for_loan_page(member.id, 1, cursor, "drill")
+            pages.append([item['id'] for item in items])
+            if not has_next:
+                break
+            cursor = (items[-1]['search_rank'], items[-1]['modified'], items[-1]['id'])
+        assert sum(pages, []) == [item['id'] for item in results]
+
+        # shorter than a trigram: substring scan
+        results = Items_For_Loan.custom_objects.get_filtered_items_for_loan(member.id, "T ")
+        assert [item['id'] for item in results] == [bits.id]
+
+    # Test that items tied on the search rank are paged once each through the page tokens
+    # (PostgreSQL: the token carries the rank as a double, the query must compare it as one)
+    @pytest.mark.django_db
+    def test_items_for_loan_custom_manager_search_rank_ties(self, member, user):
+        drills = [Items_For_Loan.objects.create(member_id=member, label="Cordless Drill", description="18V", created_by=user)
+                  for i in range(3)]
+        pages = []
+        cursor = None
+        while True:
+            items, has_next = Items_For_Loan.custom_objects.get_items_for_loan_page(member.id, 1, cursor, "drill")
+            pages.append([item['id'] for item in items])
+            if not has_next:
+                break
+            cursor = decode_page_cursor(encode_page_cursor(items[-1]['modified'], items[-1]['id'], items[-1]['search_rank']))
+        assert sorted(sum(pages, [])) == sorted(drill.id for drill in drills)
+
     # Test that setting is_deleted to True marks the item as deleted
     @pytest.mark.django_db
     def test_items_for_loan_soft_delete(self, items_for_loan):
@@ -0,0 +1,89 @@
+import datetime
+import pytest
+from django.contrib.auth.models import User
+from django.utils import timezone
+from django_q.models import Schedule
+from neighborow.models import Building, Access_Code, Member, Messages
+from neighborow.polling import DISPATCH_SCHEDULE, reschedule, wake_schedule
+
+#==================================================================================
+# SIMPLE FIXTURES FOR ALL POLLING TESTS
+#==================================================================================
+@pytest.fixture
+def dispatch_schedule(db):
+    # created by the post_migrate setup of the test database
+    schedule = Schedule.objects.get(name=DISPATCH_SCHEDULE)
+    Schedule.objects.filter(pk=schedule.pk).update(minutes=1, next_run=timezone.now() + datetime.timedelta(minutes=1))
+    return schedule
+
+@pytest.fixture
+def members(db):
+    building = Building.objects.create(name="Test Building", address_line1="Test Street 123")
+    members = []
+    for i in range(2):
+        user = User.objects.create_user(username=f"user{i}", password="neighborow")
+        access_code = Access_Code.objects.create(building_id=building, flat_no=f"Flat {i}", code=f"CODE12345678900{i}", created_by=user)
+        members.append(Member.objects.create(user_id=user, building_id=building, access_code_id=access_code,
+                                             nickname=f"nickname {i}", flat_no=f"Flat {i}", authorized=True))
+    return members
+
+# helper: minutes until the next run of a schedule
+def minutes_until_next_run(schedule):
+    schedule.refresh_from_db()
+    return round((schedule.next_run - timezone.now()).total_seconds() / 60)
+
+# Test that idle runs double the interval up to the ceiling and a run with work resets it
+@pytest.mark.django_db
+def test_reschedule_backs_off(dispatch_schedule):
+    intervals = []
+    for _ in range(5):
+        reschedule(DISPATCH_SCHEDULE, False, 4)
+        intervals.append(minutes_until_next_run(dispatch_schedule))
+    assert intervals == [1, 2, 4, 4, 4]
+
+    reschedule(DISPATCH_SCHEDULE, True, 4)
+    assert minutes_until_next_run(dispatch_schedule) == 0
+    assert dispatch_schedule.minutes == 1
+
+    assert reschedule("unknown", True, 4) is None
+
+# Test that an idle run does not back off past the next delivery retry
+@pytest.mark.django_db
+def test_reschedule_waits_for_next_retry(dispatch_schedule, members):
+    Schedule.objects.filter(pk=dispatch_schedule.pk).update(minutes=16)
+    retry_at = timezone.now() + datetime.timedelta(seconds=60)
+    Messages.objects.create(sender_member_id=members[0], receiver_member_id=members[1], title="title",
+                            body="body", message_code="RETRYCODE0000000", outbox=True, next_attempt_at=retry_at)
+    # delivered messages do not count
+    Messages.objects.create(sender_member_id=members[0], receiver_member_id=members[1], title="title", body="body",
+                            message_code="SENTCODE00000000", outbox=True, is_sent_email=True, is_sent_sms=True,
+                            is_sent_whatsApp=True, next_attempt_at=timezone.now() + datetime.timedelta(seconds=30))
+    assert Messages.custom_objects.next_retry_at() == retry_at
+
+    reschedule(DISPATCH_SCHEDULE, False, 30, Messages.custom_objects.next_retry_at())
+    dispatch_schedule.refresh_from_db()
+    assert dispatch_schedule.next_run == retry_at
+    assert dispatch_schedule.minutes == 30
+
+# Test that a new outbox message wakes the backed off dispatcher after the commit
+@pytest.mark.django_db
+def test_outbox_message_wakes_dispatcher(dispatch_schedule, members, django_capture_on_commit_callbacks):
+    Schedule.objects.filter(pk=dispatch_schedule.pk).update(minutes=16, next_run=timezone.now() + datetime.timedelta(minutes=16))
+
+    # inbox messages and delivered messages do not wake it
+    with django_capture_on_commit_callbacks(execute=True) as callbacks:
+        Messages.objects.create(sender_member_id=members[0], receiver_member_id=members[1], title="title",
+                                body="body", message_code="WAKECODE00000000", inbox=True, outbox=False)
+    assert callbacks == []
+
+    with django_capture_on_commit_callbacks(execute=True) as callbacks:
+        Messages.objects.create(sender_member_id=members[0], receiver_member_id=members[1], title="title",
+                                body="body", message_code="WAKECODE00000000", inbox=False, outbox=True,
+                                is_sent_email=False)
+    assert len(callbacks) == 1
+    assert minutes_until_next_run(dispatch_schedule) == 0
+    assert dispatch_schedule.minutes == 1
+
+    # a schedule that is already due is left alone
+    wake_schedule(DISPATCH_SCHEDULE)
+    assert minutes_until_next_run(dispatch_schedule) == 0
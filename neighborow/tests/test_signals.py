@@ -2,12 +2,13 @@ import pytest
 import datetime
 from django.utils import timezone
 from django.db import transaction
+from django.core.files.uploadedfile import SimpleUploadedFile
 
 from django.contrib.auth.models import User
 from neighborow import models
 from neighborow.models import (
     Building, Member, Access_Code, Borrowing_Request, Borrowing_Request_Recipients,
-    Messages, Communication, Items_For_Loan, Transaction, Invitation
+    Messages, Communication, Items_For_Loan, Items_For_Loan_Image, Transaction, Invitation
 )
 from neighborow.signals import (
     create_messages, create_default_communication, create_invitation_message,
@@ -95,9 +96,14 @@ def test_create_messages_signal_normal():
     
     # Check that the body of the messages includes the borrowing period and created_by = sender_user 
     for msg in messages_created:
-        assert "Required borrowing period from" in msg.body
+        assert "Required borrowing period from" in msg.text
         assert msg.created_by == sender_user
 
+    # Check that both messages share the content of the borrowing request
+    borrow_req.refresh_from_db()
+    assert {msg.content_id for msg in messages_created} == {borrow_req.content_id}
+    assert borrow_req.content_id.title == "Borrowing Request titel"
+
 
 
 
@@ -393,3 +399,52 @@ def test_update_item_availability_no_open_transaction():
     assert delta < 5
     # And currently_borrowed should be False
     assert item.currently_borrowed is False
+
+
+@pytest.mark.django_db
+# test that the primary image columns follow the first image of the item on upload, caption change and delete
+def test_update_primary_image():
+    user8 = create_test_user("user8")
+    building = Building.objects.create(name="Image Building")
+    access_code = Access_Code.objects.create(
+        building_id=building,
+        flat_no="Flat 8C",
+        code="CODE123456712348",
+        type=models.MemberType.RESIDENT,
+        is_used=False,
+        created_by=user8
+    )
+    member = Member.objects.create(
+        user_id=user8,
+        building_id=building,
+        access_code_id=access_code,
+        nickname="nickname user 8",
+        flat_no="Flat 8C",
+        authorized=True
+    )
+    item = Items_For_Loan.objects.create(member_id=member, label="Camera", description="Camera with lens")
+    modified = item.modified
+    first = Items_For_Loan_Image.objects.create(
+        items_for_loan_id=item, image=SimpleUploadedFile("front.jpg", b"front", content_type="image/jpeg"), caption="Front")
+    second = Items_For_Loan_Image.objects.create(
+        items_for_loan_id=item, image=SimpleUploadedFile("back.jpg", b"back", content_type="image/jpeg"), caption="Back")
+    item.refresh_from_db()
+    assert (item.primary_image_id, item.primary_image_url, item.primary_image_caption) == (first.id, first.image.name, "Front")
+    assert item.modified == modified
+
+    first.caption = "Front side"
+    first.save()
+    second.caption = "Back side"
+    second.save()
+    item.refresh_from_db()
+    assert item.primary_image_caption == "Front side"
+
+    first.delete()
+    item.refresh_from_db()
+    assert (item.primary_image_id, item.primary_image_url, item.primary_image_caption) == (second.id, second.image.name, "Back side")
+    listed = Items_For_Loan.custom_objects.get_items_for_loan(member.id)
+    assert [(row['image_id'], row['image_url'], row['image_caption']) for row in listed] == [(second.id, second.image.name, "Back side")]
+
+    second.delete()
+    item.refresh_from_db()
+    assert (item.primary_image_id, item.primary_image_url, item.primary_image_caption) == (None, None, None)
@@ -0,0 +1,196 @@
+import datetime
+import pytest
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_q.models import Schedule
+from neighborow.models import (
+    Building, Access_Code, Member, Items_For_Loan, Transaction, Messages, MessageType, ReminderType
+)
+from neighborow.apps import setup_schedules
+from neighborow.reminders import get_next_reminder_time, schedule_missing_transaction_reminders
+from neighborow.tasks import process_transaction_reminders, send_transaction_reminder
+
+#==================================================================================
+# SIMPLE FIXTURES FOR ALL TASK TESTS
+#==================================================================================
+@pytest.fixture
+def admin_user(db):
+    return User.objects.create_user(username="admin", password="neighborow")
+
+@pytest.fixture
+def members(db):
+    building = Building.objects.create(name="Test Building", address_line1="Test Street 123")
+    members = []
+    for i in range(2):
+        user = User.objects.create_user(username=f"user{i}", password="neighborow")
+        access_code = Access_Code.objects.create(building_id=building, flat_no=f"Flat {i}", code=f"CODE12345678900{i}", created_by=user)
+        members.append(Member.objects.create(user_id=user, building_id=building, access_code_id=access_code,
+                                             nickname=f"nickname {i}", flat_no=f"Flat {i}", authorized=True))
+    return members
+
+# helper: open loan of a new item from members[0] to members[1], due in the given time
+def create_loan(members, label, due_in, reminder=ReminderType.STANDARD, return_date=None):
+    item = Items_For_Loan.objects.create(member_id=members[0], label=label, description="Sample item description")
+    now = timezone.now()
+    return Transaction.objects.create(items_for_loan_id=item, lender_member_id=members[0], borrower_member_id=members[1],
+                                      borrowed_on=now - datetime.timedelta(days=7), borrowed_until=now + due_in,
+                                      return_date=return_date, reminder=reminder)
+
+
+#==================================================================================
+# TEST task process_transaction_reminders
+#==================================================================================
+# Test that each reminder window sends its reminder once and moves the reminder state on
+@pytest.mark.django_db
+def test_process_transaction_reminders_windows(members, admin_user):
+    loans = {
+        "tomorrow": create_loan(members, "Drill", datetime.timedelta(hours=20)),
+        "today": create_loan(members, "Ladder", datetime.timedelta(hours=1), ReminderType.REMINDER_DAY),
+        "overdue": create_loan(members, "Saw", -datetime.timedelta(hours=4), ReminderType.REMINDER_HOURS),
+        "escalate": create_loan(members, "Tent", -datetime.timedelta(days=2), ReminderType.OVERDUE),
+        "not due": create_loan(members, "Hammer", datetime.timedelta(days=3)),
+        "late, not yet 3 hours": create_loan(members, "Bike", -datetime.timedelta(hours=1), ReminderType.REMINDER_HOURS),
+        "returned": create_loan(members, "Kayak", -datetime.timedelta(days=2), return_date=timezone.now()),
+        "escalated": create_loan(members, "Grill", -datetime.timedelta(days=3), ReminderType.OVERDUE_ESC),
+    }
+
+    assert process_transaction_reminders() == 4
+
+    reminders = {loan: Transaction.objects.get(pk=trans.pk).reminder for loan, trans in loans.items()}
+    assert reminders == {
+        "tomorrow": ReminderType.REMINDER_DAY,
+        "today": ReminderType.REMINDER_HOURS,
+        "overdue": ReminderType.OVERDUE,
+        "escalate": ReminderType.OVERDUE_ESC,
+        "not due": ReminderType.STANDARD,
+        "late, not yet 3 hours": ReminderType.REMINDER_HOURS,
+        "returned": ReminderType.STANDARD,
+        "escalated": ReminderType.OVERDUE_ESC,
+    }
+    messages = Messages.objects.filter(message_type=MessageType.REMINDER)
+    assert sorted(messages.values_list('title', flat=True)) == [
+        "Reminder: please return Drill tomorrow",
+        "Reminder: please return Ladder today",
+        "Reminder: please return Saw as soon as possible",
+        "Urgently: please return Tent overdue",
+    ]
+    message = messages.get(title="Reminder: please return Drill tomorrow")
+    assert (message.sender_member_id, message.receiver_member_id, message.created_by) == (members[0], members[1], admin_user)
+    assert message.outbox and not message.inbox and not message.is_sent_email
+    assert len(set(messages.values_list('message_code', flat=True))) == 4
+
+    # the next run finds nothing new
+    assert process_transaction_reminders() == 0
+    assert messages.count() == 4
+
+# Test that a transaction in several reminder windows gets one reminder per run, the first matching one
+@pytest.mark.django_db
+def test_process_transaction_reminders_one_per_run(members, admin_user):
+    soon = create_loan(members, "Drill", datetime.timedelta(hours=1))
+    late = create_loan(members, "Saw", -datetime.timedelta(days=2))
+
+    assert process_transaction_reminders() == 2
+    messages = Messages.objects.filter(message_type=MessageType.REMINDER)
+    assert sorted(messages.values_list('title', flat=True)) == [
+        "Reminder: please return Drill tomorrow",
+        "Reminder: please return Saw as soon as possible",
+    ]
+    assert Transaction.objects.get(pk=soon.pk).reminder == ReminderType.REMINDER_DAY
+    assert Transaction.objects.get(pk=late.pk).reminder == ReminderType.OVERDUE
+
+    # the next run sends the next reminder
+    assert process_transaction_reminders() == 2
+    assert sorted(messages.values_list('title', flat=True)) == [
+        "Reminder: please return Drill today",
+        "Reminder: please return Drill tomorrow",
+        "Reminder: please return Saw as soon as possible",
+        "Urgently: please return Saw overdue",
+    ]
+
+# Test that the number of queries depends on the reminder windows, not on the number of reminders
+@pytest.mark.django_db
+def test_process_transaction_reminders_constant_queries(members, admin_user, django_assert_max_num_queries):
+    for i in range(10):
+        create_loan(members, f"Item {i}", datetime.timedelta(hours=20))
+        create_loan(members, f"Late item {i}", -datetime.timedelta(days=2), ReminderType.OVERDUE)
+    # admin user, 4 windows (savepoint, select, release), 2 windows with reminders (insert, update),
+    # next reminder schedules (delete of the escalated ones, select, insert)
+    with django_assert_max_num_queries(20):
+        assert process_transaction_reminders() == 20
+
+# Test the time the next reminder of a transaction is due in each reminder state
+@pytest.mark.django_db
+def test_get_next_reminder_time(members):
+    now = timezone.now()
+    trans = create_loan(members, "Drill", datetime.timedelta(days=3))
+    due = trans.borrowed_until
+    assert get_next_reminder_time(trans, now) == due - datetime.timedelta(days=1)
+    trans.reminder = ReminderType.REMINDER_DAY
+    assert get_next_reminder_time(trans, now) == due - datetime.timedelta(hours=2)
+    trans.reminder = ReminderType.REMINDER_HOURS
+    assert get_next_reminder_time(trans, now) == due + datetime.timedelta(hours=3)
+    trans.reminder = ReminderType.OVERDUE
+    assert get_next_reminder_time(trans, now) == due + datetime.timedelta(days=1)
+    trans.reminder = ReminderType.OVERDUE_ESC
+    assert get_next_reminder_time(trans, now) is None
+    # a window that is already open is due now
+    trans.reminder = ReminderType.STANDARD
+    assert get_next_reminder_time(trans, due - datetime.timedelta(hours=5)) == due - datetime.timedelta(hours=5)
+    trans.return_date = now
+    assert get_next_reminder_time(trans, now) is None
+
+# Test that a new loan arms a one-shot schedule that sends the reminder and arms the next one, returning cancels it
+@pytest.mark.django_db
+def test_transaction_reminder_schedule(members, admin_user, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        trans = create_loan(members, "Drill", datetime.timedelta(days=3))
+    schedule = Schedule.objects.get(name=f"transaction_reminder_{trans.pk}")
+    assert (schedule.func, schedule.schedule_type, schedule.repeats) == ("neighborow.tasks.send_transaction_reminder", Schedule.ONCE, 1)
+    assert schedule.next_run == trans.borrowed_until - datetime.timedelta(days=1)
+
+    # the schedule runs when the day window opens
+    Transaction.objects.filter(pk=trans.pk).update(borrowed_until=timezone.now() + datetime.timedelta(hours=20))
+    Schedule.objects.filter(pk=schedule.pk).update(repeats=0)
+    send_transaction_reminder(trans.pk)
+    trans.refresh_from_db()
+    schedule.refresh_from_db()
+    assert trans.reminder == ReminderType.REMINDER_DAY
+    assert Messages.objects.filter(message_type=MessageType.REMINDER).count() == 1
+    assert schedule.repeats == 1
+    assert schedule.next_run == trans.borrowed_until - datetime.timedelta(hours=2)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        trans.return_date = timezone.now()
+        trans.save()
+    assert not Schedule.objects.filter(name=f"transaction_reminder_{trans.pk}").exists()
+
+# Test that the deploy setup arms open transactions without a schedule (opened before the one-shot schedules)
+# and that the sweep leaves them alone (its cost follows the due reminders)
+@pytest.mark.django_db
+def test_schedule_missing_transaction_reminders(members, admin_user):
+    # created without running the on_commit callbacks: no schedules
+    waiting = create_loan(members, "Drill", datetime.timedelta(days=3))
+    ran = create_loan(members, "Ladder", datetime.timedelta(days=5))
+    returned = create_loan(members, "Saw", datetime.timedelta(days=3), return_date=timezone.now())
+    escalated = create_loan(members, "Tent", -datetime.timedelta(days=3), ReminderType.OVERDUE_ESC)
+    # a one-shot schedule that ran but was not armed again
+    Schedule.objects.create(name=f"transaction_reminder_{ran.pk}", func="neighborow.tasks.send_transaction_reminder",
+                            args=f"({ran.pk},)", schedule_type=Schedule.ONCE, repeats=0, next_run=timezone.now())
+
+    assert process_transaction_reminders() == 0
+    assert Schedule.objects.filter(name__startswith="transaction_reminder_").count() == 1
+
+    setup_schedules()
+
+    schedules = {schedule.name: schedule for schedule in Schedule.objects.filter(name__startswith="transaction_reminder_")}
+    assert set(schedules) == {f"transaction_reminder_{waiting.pk}", f"transaction_reminder_{ran.pk}"}
+    assert schedules[f"transaction_reminder_{waiting.pk}"].next_run == waiting.borrowed_until - datetime.timedelta(days=1)
+    assert schedules[f"transaction_reminder_{ran.pk}"].repeats == 1
+    assert not Schedule.objects.filter(name__in=[f"transaction_reminder_{returned.pk}", f"transaction_reminder_{escalated.pk}"]).exists()
+
+    # armed schedules are found with one query
+    with CaptureQueriesContext(connection) as queries:
+        assert schedule_missing_transaction_reminders() == 0
+    assert len(queries) == 1
@@ -1,12 +1,17 @@
 import pytest
-import random, string
+import string
+from django.db import IntegrityError
 from django.http import HttpResponse, JsonResponse
 from django.contrib.auth.models import User
 from neighborow.utils import (
     generate_unique_access_code,
     generate_unique_message_code,
+    generate_code_batch,
+    create_access_code,
+    create_access_codes,
     ajax_or_render
 )
+from neighborow import utils
 from neighborow.models import Access_Code, Messages, Member, Building
 
 #==================================================================================
@@ -86,22 +91,42 @@ def test_generate_unique_message_code_normal(db):
     allowed = set(string.ascii_letters + string.digits)
     assert set(code).issubset(allowed)
 
-# Test that generate_unique_message_code avoids an already existing code using monkeypatch
+# Test that generating codes does not query the database
 @pytest.mark.django_db
-def test_generate_unique_message_code_avoids_existing(db, existing_message_code, monkeypatch):
-    existing = existing_message_code  
-    new_code = "CODE123456123456"  
-    # Ensure new_code is 16 characters
-    new_code = new_code[:16] if len(new_code) > 16 else new_code.ljust(16, "X")
-    
-    call_count = {"count": 0}
-    def fake_choices(seq, k):
-        if call_count["count"] == 0:
-            call_count["count"] += 1
-            return list(existing)
-        else:
-            return list(new_code)
-    
-    monkeypatch.setattr(random, "choices", fake_choices)
-    code = generate_unique_message_code()
-    assert code == new_code
+def test_generate_codes_without_queries(db, django_assert_num_queries):
+    with django_assert_num_queries(0):
+        generate_unique_access_code()
+        generate_unique_message_code()
+        codes = generate_code_batch(50)
+    assert len(codes) == 50
+    assert len(set(codes)) == 50
+
+# Test that create_access_code draws a new code when the code is already taken
+@pytest.mark.django_db
+def test_create_access_code_retries_existing(db, existing_access_code, existing_building, existing_user, monkeypatch):
+    new_code = "CODE123456123456"
+    codes = iter([existing_access_code.code, new_code])
+    monkeypatch.setattr(utils, "generate_code", lambda: next(codes))
+    access_code = create_access_code(building_id=existing_building, flat_no="external", type="1", created_by=existing_user)
+    assert access_code.code == new_code
+    assert Access_Code.objects.count() == 2
+
+# Test that create_access_code raises IntegrityError when every attempt collides
+@pytest.mark.django_db
+def test_create_access_code_gives_up(db, existing_access_code, existing_building, existing_user, monkeypatch):
+    monkeypatch.setattr(utils, "generate_code", lambda: existing_access_code.code)
+    with pytest.raises(IntegrityError):
+        create_access_code(building_id=existing_building, flat_no="external", created_by=existing_user)
+    assert Access_Code.objects.count() == 1
+
+# Test that create_access_codes stores all codes with one insert and retries a colliding batch
+@pytest.mark.django_db
+def test_create_access_codes_batch(db, existing_access_code, existing_building, existing_user, monkeypatch, django_assert_max_num_queries):
+    batches = iter([[existing_access_code.code, "CODE000000000001"], ["CODE000000000002", "CODE000000000003"]])
+    monkeypatch.setattr(utils, "generate_code_batch", lambda count: next(batches))
+    # two attempts, each a single insert inside a savepoint
+    with django_assert_max_num_queries(8):
+        access_codes = create_access_codes(2, building_id=existing_building, flat_no="Flat 2", created_by=existing_user)
+    assert [access_code.code for access_code in access_codes] == ["CODE000000000002", "CODE000000000003"]
+    assert Access_Code.objects.count() == 3
+    assert create_access_codes(0, building_id=existing_building) == []
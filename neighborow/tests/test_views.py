@@ -1,12 +1,13 @@
 import json
+import re
 import datetime
 from django.test import TestCase, Client
 from django.urls import reverse
 from django.contrib.auth.models import User
 from neighborow.models import (
     Building, AppSettings, Access_Code, Member, Invitation,
-    Communication, Messages, Items_For_Loan, Items_For_Loan_Image,
-    Transaction
+    Communication, Messages, Message_Content, Items_For_Loan, Items_For_Loan_Image,
+    Transaction, Fan_Out_Job, FanOutStatus, Borrowing_Request, MessageType
 )
 from django.core.files.uploadedfile import SimpleUploadedFile
 
@@ -1119,6 +1120,22 @@ class NewViewsBaseTestCase(BaseViewTestCase):
         response = self.client.post(reverse('widget_borrowing_request'), post_data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         data = json.loads(response.content)
         self.assertIn('html', data)
+        # the client follows the fan-out job of the request
+        job = Fan_Out_Job.objects.get(borrowing_request__title='Ajax Test')
+        self.assertEqual((data['job_id'], data['progress_url']), (job.id, reverse('fan_out_progress', args=[job.id])))
+
+    # Test that a malformed recipient list shows the error popup and creates no borrowing request
+    def test_borrowing_post_invalid_recipient(self):
+        post_data = {
+            'selectedRecipients': f"{self.member2.id},abc",
+            'allNeighbours': 'off',
+            'subject': 'Invalid Recipient',
+            'messageBody': 'Testing a malformed recipient list'
+        }
+        response = self.client.post(reverse('widget_borrowing_request'), post_data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("cannot be created", json.loads(response.content)['html'])
+        self.assertFalse(Borrowing_Request.objects.filter(title='Invalid Recipient').exists())
 
 
 #==================================================================================
@@ -1551,6 +1568,59 @@ class TestWidgetSendMessageView_New(NewViewsBaseTestCase):
         response = self.client.get(reverse('widget_send_message'))
         self.assertEqual(response['Content-Type'], 'text/html; charset=utf-8')
 
+    # Test that a message to all neighbours stores title and body once for all recipient rows
+    def test_send_message_all_neighbours_shared_content(self):
+        post_data = {
+            'subject': 'Shared Subject',
+            'messageBody': 'Shared message body',
+            'selectedRecipients': '',
+            'allNeighbours': 'on'
+        }
+        # the fan-out task runs inline (sync cluster) once the view's transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('widget_send_message'), post_data)
+        content = Message_Content.objects.get(title='Shared Subject')
+        rows = Messages.objects.filter(content_id=content)
+        self.assertEqual(rows.count(), 2 * Member.objects.filter(building_id=self.member.building_id).count())
+        for row in rows:
+            self.assertEqual(row.title, '')
+            self.assertEqual(row.subject, 'Shared Subject')
+            self.assertEqual(row.text, 'Shared message body')
+        # the outbox widget reads the title through the shared content
+        response = self.client.get(reverse('widget_messages_outbox'), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertIn('Shared Subject', json.loads(response.content)['html'])
+
+    # Test that the response does not wait for the fan-out and the progress endpoint reports the job
+    def test_send_message_fan_out_progress(self):
+        post_data = {
+            'subject': 'Progress Subject',
+            'messageBody': 'Progress message body',
+            'selectedRecipients': str(self.member2.id),
+            'allNeighbours': 'off'
+        }
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('widget_send_message'), post_data)
+        job = Fan_Out_Job.objects.get(content_id__title='Progress Subject')
+        self.assertEqual(job.status, FanOutStatus.PENDING)
+        self.assertFalse(Messages.objects.filter(content_id=job.content_id).exists())
+        url = reverse('fan_out_progress', args=[job.id])
+        data = json.loads(response.content)
+        self.assertEqual((data['job_id'], data['progress_url']), (job.id, url))
+        self.assertEqual(json.loads(self.client.get(url).content), {'status': 'Pending', 'total': 0, 'processed': 0})
+        for callback in callbacks:
+            callback()
+        self.assertEqual(json.loads(self.client.get(url).content), {'status': 'Done', 'total': 1, 'processed': 1})
+        self.assertEqual(self.client.get(reverse('fan_out_progress', args=[job.id + 1])).status_code, 404)
+
+    # Test that the progress of a failed fan-out returns the error popup
+    def test_send_message_fan_out_progress_failed(self):
+        content = Message_Content.objects.create(title='Failed Subject', body='Failed body', created_by=self.user)
+        job = Fan_Out_Job.objects.create(message_type=MessageType.FREE_MESSAGE, sender_member_id=self.member, content_id=content,
+                                         recipient_ids=[self.member2.id], status=FanOutStatus.FAILED, total=1, created_by=self.user)
+        data = json.loads(self.client.get(reverse('fan_out_progress', args=[job.id])).content)
+        self.assertEqual(data['status'], 'Failed')
+        self.assertIn("could not be delivered to all recipients (0 of 1)", data['html'])
+
 
 #==================================================================================
 # Tests for widget_item_list view
@@ -1585,7 +1655,7 @@ class TestWidgetItemListView_New(NewViewsBaseTestCase):
     def test_item_list_not_empty(self):
         response = self.client.get(reverse('widget_item_list'))
         self.assertIn('items', response.context)
-        self.assertGreaterEqual(response.context['items'].paginator.count, 1)
+        self.assertGreaterEqual(len(response.context['items']), 1)
     
     # Test that pagination works correctly for widget_item_list
     def test_item_list_pagination(self):
@@ -1615,6 +1685,42 @@ class TestWidgetItemListView_New(NewViewsBaseTestCase):
         content = response.content.decode().lower()
         self.assertIn("test item", content)
 
+    # Test that scrolling with the next_page tokens returns every available item exactly once
+    def test_item_list_keyset_pages(self):
+        for i in range(23):
+            Items_For_Loan.objects.create(member_id=self.member, label=f"Paged item {i}",
+                                          description="Paged description", created_by=self.user)
+        expected = Items_For_Loan.custom_objects.get_items_for_loan(self.member.id)
+        seen = []
+        url = reverse('widget_item_list') + "?page=1"
+        while True:
+            data = json.loads(self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest').content)
+            seen += [int(item_id) for item_id in re.findall(r'<tr data-item-id="(\d+)"', data['html'])]
+            if not data['has_next']:
+                break
+            url = reverse('widget_item_list') + "?page=" + data['next_page']
+        self.assertEqual(seen, [item['id'] for item in expected])
+
+    # Test that the pages of a search follow the relevance order without gaps or repeats
+    def test_item_list_search_pages(self):
+        for i in range(12):
+            Items_For_Loan.objects.create(member_id=self.member, label=f"Hammer {i}",
+                                          description="Paged description", created_by=self.user)
+        for i in range(3):
+            Items_For_Loan.objects.create(member_id=self.member, label=f"Nail box {i}",
+                                          description="Fits any hammer", created_by=self.user)
+        expected = Items_For_Loan.custom_objects.get_filtered_items_for_loan(self.member.id, "hammer")
+        seen = []
+        url = reverse('widget_item_list') + "?q=hammer"
+        while True:
+            data = json.loads(self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest').content)
+            seen += [int(item_id) for item_id in re.findall(r'<tr data-item-id="(\d+)"', data['html'])]
+            if not data['has_next']:
+                break
+            url = reverse('widget_item_list') + "?q=hammer&page=" + data['next_page']
+        self.assertEqual(len(seen), 15)
+        self.assertEqual(seen, [item['id'] for item in expected])
+
 
 #==================================================================================
 # Tests for get_item_images view
@@ -33,6 +33,7 @@ urlpatterns = [
     path('messages_outbox/', views.widget_messages_outbox, name='widget_messages_outbox'),
 
     path('send_message/', views.widget_send_message, name='widget_send_message'),
+    path('fan_out_progress/<int:job_id>/', views.fan_out_progress, name='fan_out_progress'),
 
     path('item_list/', views.widget_item_list, name='widget_item_list'),
     path('item_list_search/', views.widget_item_list, name='item_list_search'),   
@@ -1,36 +1,98 @@
-import random, string
-from .models import Access_Code, Messages
+import base64, datetime, secrets, string
+from django.db import IntegrityError, transaction
+from .models import Access_Code
 from django.http import JsonResponse
 from django.template.loader import render_to_string
 from django.shortcuts import render
 
+CODE_CHARACTERS = string.ascii_letters + string.digits
+CODE_LENGTH = 16
+# attempts to store a row with a freshly generated code before giving up
+CODE_MAX_ATTEMPTS = 5
+
+# generate a cryptographically random code (16 of 62 characters, about 95 bits)
+def generate_code():
+    return ''.join(secrets.choice(CODE_CHARACTERS) for _ in range(CODE_LENGTH))
+
+# generate count distinct codes without a database query
+def generate_code_batch(count):
+    codes = set()
+    while len(codes) < count:
+        codes.add(generate_code())
+    return list(codes)
+
 # generate unique access code
+# no existence check: the unique constraint on Access_Code.code rejects the rare collision
+# when the code is saved, see create_access_code / create_access_codes
 def generate_unique_access_code():
-    characters = string.ascii_letters + string.digits
-    while True:
-        # check if code exists
-        access_code = ''.join(random.choices(characters, k=16))
-        if not Access_Code.objects.filter(code=access_code).exists():
-            # code is unique -- end loop
-            return access_code
-        
+    return generate_code()
+
+# create an access code row with a generated code, a new code is drawn if the code is taken
+def create_access_code(**fields):
+    for attempt in range(CODE_MAX_ATTEMPTS):
+        try:
+            # savepoint, so a collision does not break a surrounding transaction
+            with transaction.atomic():
+                return Access_Code.objects.create(code=generate_code(), **fields)
+        except IntegrityError:
+            if attempt == CODE_MAX_ATTEMPTS - 1:
+                raise
+
+# reserve count access codes with a single insert, all codes are drawn again if one is taken
+def create_access_codes(count, **fields):
+    if count <= 0:
+        return []
+    for attempt in range(CODE_MAX_ATTEMPTS):
+        access_codes = [Access_Code(code=code, **fields) for code in generate_code_batch(count)]
+        try:
+            with transaction.atomic():
+                return Access_Code.objects.bulk_create(access_codes)
+        except IntegrityError:
+            if attempt == CODE_MAX_ATTEMPTS - 1:
+                raise
+
 # check if request is ajax-request and return relevant rersponse
-def ajax_or_render(request, popup_template, fallback_template, context=None):
+# data: further fields of the AJAX response
+def ajax_or_render(request, popup_template, fallback_template, context=None, data=None):
     if context is None:
         context = {}
         
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         html = render_to_string(popup_template, context=context, request=request)
-        return JsonResponse({'html': html})
+        return JsonResponse({'html': html, **(data or {})})
     else:
         return render(request, fallback_template, context)
 
 # generate unique message code
+# no existence check: message codes are shared by the outbox/inbox pair and replies, so
+# uniqueness rests on the entropy of the random code
 def generate_unique_message_code():
-    characters = string.ascii_letters + string.digits
-    while True:
-        # check if code exists
-        message_code = ''.join(random.choices(characters, k=16))
-        if not Messages.objects.filter(message_code=message_code).exists():
-            # code is unique -- end loop
-            return message_code        
+    return generate_code()
+
+# generate count distinct message codes for bulk inserts
+def generate_unique_message_codes(count):
+    return generate_code_batch(count)
+
+# page token of a keyset paginated list: (modified, id) of the last row of a page,
+# search results are ordered by relevance first and add the rank: (rank, modified, id)
+def encode_page_cursor(modified, row_id, rank=None):
+    value = f"{modified.isoformat()}|{row_id}"
+    if rank is not None:
+        value = f"{float(rank)!r}|{value}"
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
+# (modified, id) or (rank, modified, id) of a page token,
+# None for the first page (no token, an old page number or an invalid token)
+def decode_page_cursor(token):
+    if not token or token.isdigit():
+        return None
+    try:
+        value = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        parts = value.split("|")
+        if len(parts) == 2:
+            return datetime.datetime.fromisoformat(parts[0]), int(parts[1])
+        if len(parts) == 3:
+            return float(parts[0]), datetime.datetime.fromisoformat(parts[1]), int(parts[2])
+        return None
+    except ValueError:
+        return None
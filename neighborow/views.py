@@ -5,13 +5,14 @@ from datetime import date, timedelta
 from django.db.models import Q
 from django.utils import timezone
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.views.generic import TemplateView
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from .models import (Building, AppSettings, Access_Code, Member, Invitation, 
                      Relationship, Borrowing_Request_Recipients, Borrowing_Request, 
-                     MemberType, Communication, Messages, MessageType, Items_For_Loan, 
-                     Items_For_Loan_Image, Transaction, Condition_Log, Condition_Image)
+                     MemberType, Communication, Messages, Message_Content, MessageType, Items_For_Loan, 
+                     Items_For_Loan_Image, Transaction, Condition_Log, Condition_Image, Fan_Out_Job, FanOutStatus)
 from django.contrib.auth.models import User
 from django.http import HttpResponse
 from django.core.exceptions import ObjectDoesNotExist
@@ -21,7 +22,10 @@ from django.db import transaction
 from .forms import MyForm
 from django.http import JsonResponse
 from django.template.loader import render_to_string
-from .utils import ajax_or_render, generate_unique_access_code, generate_unique_message_code
+from .utils import (ajax_or_render, generate_unique_access_code, generate_unique_message_code,
+                    generate_code_batch, create_access_code, encode_page_cursor, decode_page_cursor)
+from .fanout import enqueue_fan_out
+from .catalog import get_catalog_page
 from django.db.models import Prefetch
 
 logger = logging.getLogger(__name__)
@@ -130,19 +134,17 @@ def index(request):
                 messages.error(request, "Error: Invitation distance is reached! <br>You cannot invite further members!", extra_tags="popup")
                 return redirect('index')                
 
-            # get new unique access code
-            invitation_code = generate_unique_access_code()
             # Database transaction for access_code and invitation records
             try:
                 with transaction.atomic():
-                    # create an access_code record
-                    access_code = Access_Code.objects.create(building_id = member.building_id,
-                                                            flat_no = 'external',
-                                                            code = invitation_code,
-                                                            type = '1',
-                                                            is_used = False,
-                                                            created_by = user_instance
+                    # create an access_code record with a new unique code
+                    access_code = create_access_code(building_id = member.building_id,
+                                                     flat_no = 'external',
+                                                     type = '1',
+                                                     is_used = False,
+                                                     created_by = user_instance
                     )
+                    invitation_code = access_code.code
                     # create an invitation record
                     invitation = Invitation.objects.create(building_id = member.building_id,
                                                            invitor_member_id = member,
@@ -485,7 +487,7 @@ def generate_codes(request):
     # Ensure count is non-negative
     if count < 0:
         count = 0
-    codes = [generate_unique_access_code() for _ in range(count)]
+    codes = generate_code_batch(count)
     return JsonResponse({'codes': codes})
 
 
@@ -527,14 +529,17 @@ def widget_borrowing(request):
         # get the logged in member
         member = Member.objects.get(user_id=user_instance)
 
-        # load recipients in comma seperated list (same as selected members)
-        if all_recipients == 'on':
-            # get all members of the same building
-            member_list = Member.objects.filter(building_id=member.building_id)
-
-        # create records in table Borrowing_Request_Recipients and Borrowing_Request
-        # Database transaction for access_code and invitation records
+        # create the Borrowing_Request record, the fan-out task creates the
+        # Borrowing_Request_Recipients records and messages after the commit
+        job = None
         try:
+            # load recipients in comma seperated list (same as selected members)
+            # all members of the same building are resolved by the fan-out task
+            if all_recipients == 'on':
+                recipient_ids = []
+            else:
+                recipient_ids = [int(recipient_id) for recipient_id in (selected_recipients or '').split(',') if recipient_id.strip()]
+
             with transaction.atomic():
                 borrowing_request = Borrowing_Request.objects.create(member_id=member,
                                                         title = request.POST.get('subject'),
@@ -543,26 +548,14 @@ def widget_borrowing(request):
                                                         required_until = required_until,
                                                         created_by = user_instance  
                                                         )              
+                job = enqueue_fan_out(message_type=MessageType.BORREQ,
+                                sender_member_id=member,
+                                      borrowing_request=borrowing_request,
+                                      all_recipients=(all_recipients == 'on'),
+                                      recipient_ids=recipient_ids,
+                                      created_by=user_instance
+                                      )
 
-                if all_recipients == 'on':
-                    for member in member_list:
-                        recipient = Borrowing_Request_Recipients(
-                            member_id=member,
-                            borrowing_request=borrowing_request,
-                            created_by=user_instance
-                        )
-                        recipient.save()
-                else:
-                    if selected_recipients:
-                        for recipient_id in selected_recipients.split(','):
-                            recipient = Borrowing_Request_Recipients(
-                                member_id_id=int(recipient_id),
-                                borrowing_request=borrowing_request,
-                                created_by=user_instance
-                            )
-                            recipient.save()
-
-                
         except Exception as e:        
             # DB transcation failed
             logger.exception("Error creating borrowing request: %s", e)
@@ -571,8 +564,9 @@ def widget_borrowing(request):
         # Message if request was successfully stored in DB:
         messages.success(request, "The borrowing Request has been sent successfully!", extra_tags="popup")
         
-        # For AJAX-requests return HTML-Code for popup
-        return ajax_or_render(request, 'neighborow/popup_modal.html', 'neighborow/index.html')
+        # For AJAX-requests return HTML-Code for popup and the fan-out job to follow
+        return ajax_or_render(request, 'neighborow/popup_modal.html', 'neighborow/index.html',
+                              data=get_fan_out_response_data(job))
         # if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         #     html = render_to_string('neighborow/popup_modal.html', request=request)
         #     return JsonResponse({'html': html})
@@ -767,7 +761,7 @@ def widget_messages_inbox(request):
     qs = Messages.objects.filter(
                                 Q(receiver_member_id=member),
                                 (Q(inbox=True) | Q(internal=True))
-                                ).order_by('-created')
+                                ).select_related('content_id', 'sender_member_id').order_by('-created')
     paginator = Paginator(qs, messages_per_page)
     try:
         page_obj = paginator.page(page)
@@ -873,7 +867,7 @@ def widget_messages_outbox(request):
     qs = Messages.objects.filter(
             Q(sender_member_id=member),
             Q(outbox=True)
-          ).order_by('-created')
+          ).select_related('content_id', 'receiver_member_id').order_by('-created')
     paginator = Paginator(qs, messages_per_page)
     try:
         page_obj = paginator.page(page)
@@ -895,6 +889,28 @@ def widget_messages_outbox(request):
     
 
 
+# fields of a send response that let the client follow the background fan-out (see fan_out_progress)
+def get_fan_out_response_data(job):
+    if job is None:
+        return {}
+    return {'job_id': job.id, 'progress_url': reverse('fan_out_progress', args=[job.id])}
+
+# progress of the background fan-out of a broadcast sent by the logged in user
+# a failed fan-out also returns the popup telling the user
+@login_required
+def fan_out_progress(request, job_id):
+    try:
+        job = Fan_Out_Job.objects.get(pk=job_id, created_by=request.user)
+    except Fan_Out_Job.DoesNotExist:
+        return JsonResponse({"error": "Job not found"}, status=404)
+    data = {"status": job.get_status_display(), "total": job.total, "processed": job.processed}
+    if job.status == FanOutStatus.FAILED:
+        messages.error(request, f"Error: Your message could not be delivered to all recipients "
+                                f"({job.processed} of {job.total})! Please try again later.", extra_tags="popup")
+        data['html'] = render_to_string('neighborow/popup_modal.html', request=request)
+    return JsonResponse(data)
+
+
 @login_required
 def widget_send_message(request):
     if request.method == 'POST':
@@ -912,48 +928,28 @@ def widget_send_message(request):
         user_instance = User.objects.get(username=request.user)
         member = Member.objects.get(user_id=user_instance)
         
+        # all members of the same building are resolved by the fan-out task
         if all_recipients == 'on':
-            recipient_list = Member.objects.filter(building_id=member.building_id)
+            recipient_ids = []
         else:
             recipient_ids = [int(rid) for rid in selected_recipients.split(',') if rid.strip()]
-            recipient_list = Member.objects.filter(id__in=recipient_ids)
         
         try:
             with transaction.atomic():
-                for recipient in recipient_list:
-                    message_code = generate_unique_message_code()
-                    # Message for sender
-                    Messages.objects.create(
-                        sender_member_id=member,
-                        receiver_member_id=recipient,
-                        title=subject,
-                        body=message_body,
-                        message_code=message_code,
-                        inbox=False,
-                        outbox=True,
-                        internal=False,
-                        is_sent_email=False,
-                        is_sent_sms=False,
-                        is_sent_whatsApp=False,
-                        message_type=MessageType.FREE_MESSAGE.value,
-                        created_by=user_instance
-                    )
-                    # Message for receiver
-                    Messages.objects.create(
-                        sender_member_id=member,
-                        receiver_member_id=recipient,
-                        title=subject,
-                        body=message_body,
-                        message_code=message_code,
-                        inbox=True,
-                        outbox=False,
-                        internal=False,
-                        is_sent_email=True,
-                        is_sent_sms=True,
-                        is_sent_whatsApp=True,
-                        message_type=MessageType.FREE_MESSAGE.value,
-                        created_by=user_instance
-                    )
+                # title and body are stored once and shared by all recipients
+                content = Message_Content.objects.create(
+                    title=subject,
+                    body=message_body,
+                    created_by=user_instance
+                )
+                # outbox and inbox messages are written by the fan-out task after the commit
+                job = enqueue_fan_out(message_type=MessageType.FREE_MESSAGE,
+                                      sender_member_id=member,
+                                      content_id=content,
+                                      all_recipients=(all_recipients == 'on'),
+                                      recipient_ids=recipient_ids,
+                                      created_by=user_instance
+                                      )
         except Exception as e:
             logger.exception("Error sending message: %s", e)
             messages.error(request, "Error: Message cannot be sent! Please try again later.", extra_tags="popup")
@@ -962,7 +958,7 @@ def widget_send_message(request):
         
         messages.success(request, "Message sent successfully!", extra_tags="popup")
         html = render_to_string('neighborow/popup_modal.html', request=request)
-        return JsonResponse({'html': html})
+        return JsonResponse({'html': html, **get_fan_out_response_data(job)})
     else:
         return render(request, 'neighborow/widgets/send_message.html')
     
@@ -970,39 +966,35 @@ def widget_send_message(request):
 @login_required
 def widget_item_list(request):
     query = request.GET.get('q', '').strip()
-    page = request.GET.get('page', 1)
-    try:
-        page = int(page)
-    except ValueError:
-        page = 1
+    # page: token of the last item of the previous page (see encode_page_cursor), missing for the first page
+    cursor = decode_page_cursor(request.GET.get('page'))
+    # search pages continue behind (rank, modified, id), a token of the other list starts over
+    if cursor is not None and len(cursor) != (3 if query else 2):
+        cursor = None
 
     user_instance = request.user
     member = Member.objects.get(user_id=user_instance)
-    
-    if query:
-        items_list = Items_For_Loan.custom_objects.get_filtered_items_for_loan(member.id, query)
-    else:
-        items_list = Items_For_Loan.custom_objects.get_items_for_loan(member.id)
-    
-    paginator = Paginator(items_list, 10)
-    try:
-        items_page = paginator.page(page)
-    except (PageNotAnInteger, EmptyPage):
-        items_page = []
+
+    # only the requested page is read, from the building's catalog cache or the database
+    items_page, has_next = get_catalog_page(member, 10, cursor, query or None)
+    next_page = None
+    if has_next:
+        last = items_page[-1]
+        next_page = encode_page_cursor(last['modified'], last['id'], last['search_rank'] if query else None)
 
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or 'q' in request.GET or 'page' in request.GET:
         html = render_to_string('neighborow/partials/item_list_rows.html', {'items': items_page, 'member': member}, request=request)
         return JsonResponse({
             'html': html, 
-            'has_next': items_page.has_next() if items_page else False,
-            'next_page': page + 1
+            'has_next': has_next,
+            'next_page': next_page
         })
     else:
         return render(request, 'neighborow/widgets/items_for_loan.html', {
             'items': items_page,
             'member': member,
-            'has_next': items_page.has_next() if items_page else False,
-            'next_page': page + 1
+            'has_next': has_next,
+            'next_page': next_page
         })
     
 
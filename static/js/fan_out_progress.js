@@ -0,0 +1,30 @@
+/**
+ * fan_out_progress.js
+ *
+ * Messages to many neighbours are written by a background job after the form has been sent.
+ * This module follows the job and shows the server popup if the job fails.
+ * It exports one function:
+ *   - watchFanOutProgress: Called with the response of a sent form
+ */
+
+// seconds between two progress requests
+const FAN_OUT_POLL_SECONDS = 2;
+
+// poll the progress url of the response until the job is done or failed
+export function watchFanOutProgress(data, showPopupModal) {
+  if (!data || !data.progress_url) {
+    return;
+  }
+  fetch(data.progress_url, { headers: { 'X-Requested-With': 'XMLHttpRequest' } })
+    .then(response => response.json())
+    .then(progress => {
+      if (progress.status === 'Failed') {
+        if (progress.html) {
+          showPopupModal(progress.html);
+        }
+      } else if (progress.status !== 'Done' && !progress.error) {
+        setTimeout(() => watchFanOutProgress(data, showPopupModal), FAN_OUT_POLL_SECONDS * 1000);
+      }
+    })
+    .catch(error => console.error('Error reading fan-out progress:', error));
+}
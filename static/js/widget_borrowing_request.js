@@ -7,6 +7,8 @@
  *   - initRestoredWidget: For reinitializing a restored widget
  */
 
+import { watchFanOutProgress } from './fan_out_progress.js';
+
 export function initWidgetBorrowingRequest(appendWidget, bringWidgetToFront, showPopupModal) {
   // Fetch the widget HTML from the server
   fetch('borrowing_request/')
@@ -41,6 +43,7 @@ export function initWidgetBorrowingRequest(appendWidget, bringWidgetToFront, sho
           .then(data => {
             // Display the server response in a popup modal
             showPopupModal(data.html);
+            watchFanOutProgress(data, showPopupModal);
             form.reset();
           })
           .catch(error => console.error('Error sending borrowing request:', error));
@@ -109,6 +112,7 @@ export function initRestoredWidget(widgetElement, bringWidgetToFront, showPopupM
       .then(data => {
         // Show response modal and reset form after submission
         showPopupModal(data.html);
+        watchFanOutProgress(data, showPopupModal);
         form.reset();
       })
       .catch(error => console.error('Error sending borrowing request:', error));
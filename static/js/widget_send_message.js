@@ -7,6 +7,8 @@
  *   - initRestoredWidget: Called on widget restoration (from saved state)
  */
 
+import { watchFanOutProgress } from './fan_out_progress.js';
+
 // Initialize widget send message module
 export function initWidgetSendMessage(appendWidget, bringWidgetToFront, getCookie, showPopupModal) {
   // load widget html
@@ -39,6 +41,7 @@ export function initWidgetSendMessage(appendWidget, bringWidgetToFront, getCooki
           .then(data => {
             // show Popup 
             showPopupModal(data.html);
+            watchFanOutProgress(data, showPopupModal);
             form.reset();
             widgetElement.remove();  // Widget close
           })
@@ -103,6 +106,7 @@ export function initRestoredWidget(widgetElement, bringWidgetToFront, showPopupM
       .then(response => response.json())
       .then(data => {
         showPopupModal(data.html);
+        watchFanOutProgress(data, showPopupModal);
         form.reset();
         widgetElement.remove();  
       })